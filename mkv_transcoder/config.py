@@ -51,6 +51,33 @@ else:
 # This leverages system memory to speed up I/O for non-video files.
 RAM_TEMP_DIR = os.getenv("TRANSCODER_RAM_DIR", "/dev/shm")
 
+# Video encoder for the re-encode step: 'libx265' (software), or the hardware encoders
+# 'hevc_nvenc' (NVIDIA), 'hevc_qsv' (Intel Quick Sync) and 'hevc_vaapi' (Intel/AMD, using
+# VAAPI_DEVICE). 'auto' uses the first hardware encoder that works on the machine, falling back
+# to libx265. Hardware encodes are far faster but larger at the same visual quality.
+ENCODER = os.getenv("TRANSCODER_ENCODER", "libx265")
+VAAPI_DEVICE = os.getenv("VAAPI_DEVICE", "/dev/dri/renderD128")
+
+# x265 threading. X265_POOLS is passed as x265's 'pools' option: '+' uses every core of
+# the machine, a number limits the pool to that many threads. 'auto' splits the cores evenly
+# between MAX_CONCURRENT_ENCODES encodes. X265_FRAME_THREADS of 0 lets x265 pick.
+X265_POOLS = os.getenv("X265_POOLS", "auto")
+X265_FRAME_THREADS = int(os.getenv("X265_FRAME_THREADS", "0"))
+# x265's 'asm' option. 'auto' enables AVX-512 when the CPU has it (x265 leaves it off unless
+# asked) and otherwise lets x265 pick; any other value is passed through as is.
+X265_ASM = os.getenv("X265_ASM", "auto")
+
+# Read the source straight from the share instead of copying it to staging first. Saves the
+# copy, but every step that reads the source then goes over the network.
+READ_SOURCE_IN_PLACE = os.getenv("READ_SOURCE_IN_PLACE", "0") == "1"
+
+# How many x265 encodes may run at once on one machine when a worker runs several jobs
+# concurrently (worker.py --jobs). The other steps of those jobs overlap freely.
+MAX_CONCURRENT_ENCODES = int(os.getenv("MAX_CONCURRENT_ENCODES", "1"))
+# Pin each concurrent encode to its own share of the cores (Linux only), so that encodes
+# don't migrate between each other's cores. Only matters with MAX_CONCURRENT_ENCODES > 1.
+PIN_ENCODES = os.getenv("PIN_ENCODES", "0") == "1"
+
 # Worker settings
 STALE_JOB_THRESHOLD_HOURS = 2
 TRANSCODER_VMS = [f"10.50.50.11{i}" for i in range(4)] # 110-113
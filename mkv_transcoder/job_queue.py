@@ -1,212 +1,696 @@
 # mkv_transcoder/job_queue.py
 
+import contextlib
+import copy
 import json
+import logging
 import os
+import random
+import re
+import shutil
+import sys
 import time
 import uuid
+from collections import deque
+from types import MappingProxyType
 import portalocker
 from . import config
 
+log = logging.getLogger(__name__)
+
+try:
+    # orjson is considerably faster than the stdlib encoder; it is optional.
+    import orjson
+except ImportError:
+    orjson = None
+
+def _dumps(obj):
+    """Serializes an object to compact UTF-8 encoded JSON."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+def _loads(data):
+    """Parses JSON from bytes or str."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+try:
+    # ijson lets the queue file be loaded one job at a time instead of parsing it as a whole; it is optional.
+    import ijson
+    _JSON_ERRORS = (json.JSONDecodeError, ijson.JSONError)
+except ImportError:
+    ijson = None
+    _JSON_ERRORS = (json.JSONDecodeError,)
+
+def _iter_queue_jobs(f):
+    """Yields the job records of a queue file opened in binary mode."""
+    if ijson is None:
+        data = f.read()
+        queue_data = _loads(data) if data.strip() else {'jobs': []}
+        # Legacy support: the queue used to be a bare list of jobs
+        if isinstance(queue_data, list):
+            queue_data = {'jobs': queue_data}
+        yield from queue_data.get('jobs', [])
+        return
+
+    first = f.read(1)
+    while first.isspace():
+        first = f.read(1)
+    if not first:
+        return
+    f.seek(-1, os.SEEK_CUR)
+    # Legacy support: the queue used to be a bare list of jobs
+    prefix = 'item' if first == b'[' else 'jobs.item'
+    yield from ijson.items(f, prefix, use_float=True)
+
+# Each compaction bumps the queue's generation. It leads both the queue file and the WAL, so a
+# process can tell whether its WAL offset still belongs to the file it loaded without trusting
+# file attributes, which SMB/NFS clients may cache. Files written before generations existed
+# count as generation 0.
+_GENERATION_PATTERN = re.compile(rb'\s*\{\s*"generation"\s*:\s*(\d+)')
+
+def _read_generation(fd):
+    """Returns the generation at the start of a queue file or WAL, or None if the file is empty."""
+    os.lseek(fd, 0, os.SEEK_SET)
+    head = os.read(fd, 64)
+    if not head:
+        return None
+    match = _GENERATION_PATTERN.match(head)
+    return int(match.group(1)) if match else 0
+
+def _fsync_dir(path):
+    """Makes a rename within a directory durable. Directories can't be opened for this on Windows."""
+    if os.name == 'nt':
+        return
+    fd = os.open(path or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _write_atomic(path, data):
+    """Replaces a file's contents via a synced temporary file, so it is never left half-written."""
+    tmp_file = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_file, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, path)
+        _fsync_dir(os.path.dirname(path))
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+# The write-ahead log is folded back into the canonical queue file once it grows
+# past this multiple of the canonical file's size (with a small floor so an empty
+# queue isn't compacted on every write).
+WAL_COMPACT_RATIO = 4
+WAL_COMPACT_MIN_BYTES = 64 * 1024
+
+# Bounds, in seconds, of the randomized exponential backoff between attempts to take the
+# queue lock, so waiting workers don't all wake up and retry at the same moment.
+LOCK_BACKOFF_MIN = 0.001
+LOCK_BACKOFF_MAX = 0.5
+
+# Initial step statuses for each job type; copied into every new job
+_STEPS_TEMPLATES = MappingProxyType({
+    'dolby_vision': MappingProxyType({
+        'copy_source': 'pending',
+        'get_metadata': 'pending',
+        # Also extracts the P7 stream, which is piped into the converter and the RPU extraction
+        'convert_p8': 'pending',
+        # Also injects the RPU, which the encoded stream is piped into
+        'reencode_x265': 'pending',
+        'remux_final': 'pending',
+        'move_final': 'pending'
+    }),
+    # The re-encode step also handles muxing for standard jobs
+    'standard': MappingProxyType({
+        'copy_source': 'pending',
+        'get_metadata': 'pending',
+        'reencode_x265': 'pending',
+        'move_final': 'pending'
+    }),
+})
+
+# Steps in the order they run; a step index (as given to the reset methods) is 1-based
+# into this tuple. Standard jobs run a subset of these, in the same order.
+STEP_ORDER = tuple(_STEPS_TEMPLATES['dolby_vision'])
+STEP_INDEX = {step: i for i, step in enumerate(STEP_ORDER, start=1)}
+
+# Steps of earlier versions whose work is now done by another step, for jobs queued by them
+_MERGED_STEPS = MappingProxyType({
+    'extract_p7': 'convert_p8',
+    'extract_rpu': 'convert_p8',
+    'inject_rpu': 'reencode_x265',
+})
+
+def _migrate_steps(steps):
+    """
+    Folds the statuses of steps that have been merged into other steps into those steps. A
+    merged step is only completed if all of its parts were, and failed if any of them was.
+    """
+    if not any(step in _MERGED_STEPS for step in steps):
+        return steps
+    migrated = {}
+    for step, status in steps.items():
+        step = _MERGED_STEPS.get(step, step)
+        if migrated.get(step, 'completed') == 'completed' or status == 'failed':
+            migrated[step] = status
+    return migrated
+
+# Number of attempts a job gets before it is quarantined as 'failed_permanent'
+MAX_RETRIES = 3
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+def _intern_job(job):
+    """
+    Returns a loaded job record with its keys, status and steps interned, so that all jobs
+    in memory share one string object for each of them (the streaming parser allocates
+    fresh key strings for every record). Steps of earlier versions are migrated.
+    """
+    job = {sys.intern(key): value for key, value in job.items()}
+    job['status'] = _intern(job.get('status'))
+    if isinstance(job.get('steps'), dict):
+        job['steps'] = {sys.intern(step): _intern(status) for step, status in _migrate_steps(job['steps']).items()}
+    return job
+
 class JobQueue:
     def __init__(self, queue_file=config.JOB_QUEUE_PATH):
         self.queue_file = queue_file
-        # Ensure the queue file exists and has the correct structure
-        if not os.path.exists(self.queue_file):
-            os.makedirs(os.path.dirname(self.queue_file), exist_ok=True)
-            with open(self.queue_file, 'w') as f:
-                json.dump({'jobs': []}, f, indent=4)
+        # Mutations are appended here as one JSON record per line instead of rewriting the whole queue
+        self.wal_file = os.path.splitext(queue_file)[0] + '.wal'
+        # A separate lock file, because compaction replaces the queue file rather than rewriting it in place
+        self.lock_file = os.path.splitext(queue_file)[0] + '.lock'
+        # Ensure the queue file exists and has the correct structure. O_EXCL makes sure that of
+        # several workers starting at once, only one creates it.
+        os.makedirs(os.path.dirname(self.queue_file) or '.', exist_ok=True)
+        try:
+            fd = os.open(self.queue_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o644)
+        except FileExistsError:
+            pass
+        else:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(_dumps({'generation': 0, 'jobs': []}))
+
+        # In-memory copy of the queue, indexed by job id and input path.
+        self._jobs = []
+        self._by_id = {}
+        self._by_path = {}
+        # Ids of claimable jobs in the order they became claimable; entries whose status has
+        # since changed are skipped when popped.
+        self._pending = deque()
+        self._failed = deque()
+        # Records touched by the current operation: whole jobs, and the changed fields/steps of other jobs
+        self._dirty = {}
+        self._patches = {}
+        # Generation and size of the canonical file when it was last loaded (None to force a
+        # reload), and how much of the WAL has been applied
+        self._generation = None
+        self._queue_size = 0
+        self._wal_offset = 0
+        # The WAL is opened once and kept open for both replaying and appending
+        self._wal_fd = None
+        self._wal_size = 0
+        self._execute_with_lock(lambda jobs: None)
+
+    def _load(self):
+        """Loads the canonical queue file into memory, replacing the current in-memory state."""
+        self._jobs = []
+        self._by_id = {}
+        self._by_path = {}
+        self._pending = deque()
+        self._failed = deque()
+        with open(self.queue_file, 'rb') as f:
+            generation = _read_generation(f.fileno()) or 0
+            f.seek(0)
+            for job in _iter_queue_jobs(f):
+                self._put(job)
+            size = os.fstat(f.fileno()).st_size
+        # Jobs are claimed oldest first. Sort once here (a no-op pass for a file that is already
+        # in order); from then on new jobs are appended in order and claims never sort.
+        self._jobs.sort(key=lambda job: job.get('added_at') or 0)
+        self._pending = deque(job['id'] for job in self._jobs if job.get('status') == 'pending')
+        self._failed = deque(job['id'] for job in self._jobs if job.get('status') == 'failed')
+        self._generation = generation
+        self._queue_size = size
+        self._wal_offset = 0
+
+    def _put(self, job):
+        """Inserts a job record into memory, or replaces the existing record with the same id. Returns the stored record."""
+        job = _intern_job(job)
+        existing = self._by_id.get(job['id'])
+        if existing is not None:
+            old_status = existing.get('status')
+            existing.clear()
+            existing.update(job)
+            job = existing
+        else:
+            old_status = None
+            self._jobs.append(job)
+            self._by_id[job['id']] = job
+        self._by_path[job.get('input_path')] = job
+        if job.get('status') != old_status:
+            self._enqueue(job)
+        return job
+
+    def _enqueue(self, job):
+        """Makes a job claimable again if its status is 'pending' or 'failed'."""
+        if job.get('status') == 'pending':
+            self._pending.append(job['id'])
+        elif job.get('status') == 'failed':
+            self._failed.append(job['id'])
+
+    def _set_status(self, job, status):
+        """Changes a job's status, keeping the pending/failed indexes up to date."""
+        if job.get('status') != status:
+            job['status'] = status
+            self._enqueue(job)
+
+    def _sync(self, exclusive=True):
+        """
+        Brings the in-memory queue up to date with changes made by other processes. exclusive
+        says whether the caller holds the lock exclusively, which repairing the WAL needs.
+        """
+        with open(self.queue_file, 'rb') as f:
+            generation = _read_generation(f.fileno()) or 0
+        fd = self._wal()
+        self._wal_size = os.fstat(fd).st_size
+        if generation != self._generation or self._wal_size < self._wal_offset:
+            # Another process compacted the queue (or this is the first load)
+            self._load()
+        wal_generation = _read_generation(fd)
+        if wal_generation is not None and wal_generation < self._generation:
+            # A compaction died after replacing the queue file; the file already holds these records
+            if not exclusive:
+                self._wal_offset = self._wal_size
+                return
+            self._reset_wal(self._generation)
+        elif wal_generation is not None and wal_generation > self._generation:
+            # Don't apply the WAL to an older queue file than it was written against
+            raise IOError(f"job queue WAL is at generation {wal_generation}, but the queue file at {self._generation}")
+        if self._wal_size == self._wal_offset:
+            return
+
+        os.lseek(fd, self._wal_offset, os.SEEK_SET)
+        chunks = []
+        remaining = self._wal_size - self._wal_offset
+        while remaining > 0:
+            chunk = os.read(fd, remaining)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        data = b''.join(chunks)
+
+        # Only apply complete lines; a torn record from a crashed writer is dropped on the next append
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            if line.strip():
+                self._apply_wal_record(_loads(line))
+        self._wal_offset += end
+
+    def _apply_wal_record(self, record):
+        """Applies one WAL record: either a whole job, or a patch of some of a job's fields and step statuses."""
+        if 'generation' in record:
+            return # The WAL's header
+        if 'patch' not in record:
+            self._put(record)
+            return
+        job = self._by_id.get(record['patch'])
+        if job is None:
+            return
+        fields = dict(record.get('set', {}))
+        if 'status' in fields:
+            self._set_status(job, _intern(fields.pop('status')))
+        job.update(fields)
+        if 'steps' in record:
+            steps = job.setdefault('steps', {})
+            for step, status in record['steps'].items():
+                steps[step] = _intern(status)
+
+    def _wal(self):
+        """Returns the file descriptor of the WAL, opening it on first use."""
+        if self._wal_fd is None:
+            flags = os.O_RDWR | os.O_APPEND | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+            self._wal_fd = os.open(self.wal_file, flags, 0o644)
+        return self._wal_fd
+
+    def _reset_wal(self, generation):
+        """Empties the WAL, once the queue file holds everything in it, and starts it at a new generation."""
+        fd = self._wal()
+        os.ftruncate(fd, 0)
+        header = _dumps({'generation': generation}) + b'\n'
+        os.write(fd, header)
+        self._generation = generation
+        self._wal_offset = len(header)
+        self._wal_size = self._wal_offset
+
+    def _mark_dirty(self, job):
+        """Records that a job was modified by the current operation and must be persisted."""
+        self._dirty[job['id']] = job
+
+    def _mark_fields_dirty(self, job, *fields):
+        """Records that only some top-level fields of a job were modified by the current operation."""
+        self._patches.setdefault(job['id'], (set(), set()))[0].update(fields)
+
+    def _mark_step_dirty(self, job, step):
+        """Records that only one step status of a job was modified by the current operation."""
+        self._patches.setdefault(job['id'], (set(), set()))[1].add(step)
+
+    def _patch_record(self, job_id, fields, steps):
+        """Builds the WAL record for a partial update with the current values of the given fields and steps."""
+        job = self._by_id[job_id]
+        record = {'patch': job_id}
+        if fields:
+            record['set'] = {field: job.get(field) for field in fields}
+        if steps:
+            record['steps'] = {step: job['steps'][step] for step in steps}
+        return record
+
+    def _append_wal(self):
+        """Appends the modified job records to the WAL in a single write."""
+        records = list(self._dirty.values())
+        # A patch is a few dozen bytes instead of the whole job record
+        records.extend(self._patch_record(job_id, fields, steps)
+                       for job_id, (fields, steps) in self._patches.items() if job_id not in self._dirty)
+        payload = b''.join(_dumps(record) + b'\n' for record in records)
+        fd = self._wal()
+        if self._wal_size > self._wal_offset:
+            # Drop a partial record left behind by a writer that died mid-append
+            os.ftruncate(fd, self._wal_offset)
+        view = memoryview(payload)
+        while view:
+            view = view[os.write(fd, view):]
+        self._wal_offset += len(payload)
+        self._wal_size = self._wal_offset
+
+    @contextlib.contextmanager
+    def _locked(self, shared=False):
+        """Holds the queue's lock for the duration of the block; shared locks only exclude writers."""
+        flags = (portalocker.LOCK_SH if shared else portalocker.LOCK_EX) | portalocker.LOCK_NB
+        with open(self.lock_file, 'a') as lock:
+            attempt = 0
+            while True:
+                try:
+                    portalocker.lock(lock, flags)
+                    break
+                except portalocker.LockException:
+                    time.sleep(random.uniform(LOCK_BACKOFF_MIN, min(LOCK_BACKOFF_MAX, 0.01 * 2 ** attempt)))
+                    attempt = min(attempt + 1, 10)
+            try:
+                yield
+            finally:
+                portalocker.unlock(lock)
+
+    def _compact(self):
+        """
+        Folds the WAL into a new canonical queue file.
+
+        The snapshot is serialized and written without holding the lock. The lock is only
+        retaken to swap the file in, and the swap is abandoned if another process changed
+        the queue in the meantime; the next write will simply try again.
+        """
+        snapshot = (self._generation, self._wal_offset)
+        tmp_file = f"{self.queue_file}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_file, 'wb') as f:
+                f.write(_dumps({'generation': self._generation + 1, 'jobs': self._jobs}))
+                size = f.tell()
+                f.flush()
+                os.fsync(f.fileno())
+            with self._locked():
+                self._sync()
+                if (self._generation, self._wal_offset) != snapshot or self._wal_size != self._wal_offset:
+                    return
+                os.replace(tmp_file, self.queue_file)
+                # The new file must be durable before the WAL records it replaces are dropped
+                _fsync_dir(os.path.dirname(self.queue_file))
+                self._reset_wal(self._generation + 1)
+                self._queue_size = size
+        except OSError as e:
+            log.warning("Could not compact job queue file at %s: %s", self.queue_file, e)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
 
     def _execute_with_lock(self, operation):
         """A robust, file-locking wrapper to perform operations on the job queue."""
         try:
-            with open(self.queue_file, 'r+') as f:
-                portalocker.lock(f, portalocker.LOCK_EX)
+            with self._locked():
+                # Catch up with other processes, then perform the requested operation in memory
+                self._sync()
+                self._dirty = {}
+                self._patches = {}
+                try:
+                    result = operation(self._jobs)
+                except Exception:
+                    # The in-memory state may be half-modified; reload it on the next call
+                    self._generation = None
+                    raise
+
+                # Persist only the records the operation touched
+                compact = False
+                if self._dirty or self._patches:
+                    self._append_wal()
+                    self._dirty = {}
+                    self._patches = {}
+                    compact = self._wal_offset > WAL_COMPACT_RATIO * max(self._queue_size, WAL_COMPACT_MIN_BYTES)
+            if compact:
+                self._compact()
+            return result
+        except _JSON_ERRORS as e:
+            log.error("Could not parse job queue file at %s: %s", self.queue_file, e)
+            self._generation = None
+            self._recover()
+            return None
+        except IOError as e:
+            log.error("Could not access job queue file at %s: %s", self.queue_file, e)
+            self._generation = None
+            return None
+
+    def _recover(self):
+        """
+        Sets aside whichever of the queue file and the WAL can't be parsed, keeping a copy of
+        it next to the queue for manual recovery, and carries on with what could be read.
+        """
+        suffix = time.strftime('%Y%m%d-%H%M%S')
+        try:
+            with self._locked():
+                try:
+                    self._load()
+                except _JSON_ERRORS:
+                    corrupt_file = f"{self.queue_file}.corrupt-{suffix}"
+                    os.replace(self.queue_file, corrupt_file)
+                    # At the WAL's generation, so that the WAL still applies to the new file
+                    generation = _read_generation(self._wal()) or 0
+                    _write_atomic(self.queue_file, _dumps({'generation': generation, 'jobs': []}))
+                    log.warning("Moved unreadable job queue file to %s. Jobs logged since the last compaction are kept.", corrupt_file)
+                    self._load()
                 try:
-                    # Read the current state
-                    data = f.read()
-                    if not data:
-                        queue_data = {'jobs': []}
-                    else:
-                        queue_data = json.loads(data)
-                    
-                    # Legacy support: convert list to dict
-                    if isinstance(queue_data, list):
-                        queue_data = {'jobs': queue_data}
-
-                    # Perform the requested operation
-                    result = operation(queue_data)
-
-                    # Write the modified state back to the file
-                    f.seek(0)
-                    f.truncate()
-                    json.dump(queue_data, f, indent=4)
-                    return result
-                finally:
-                    portalocker.unlock(f)
-        except (IOError, json.JSONDecodeError) as e:
-            print(f"ERROR: Could not access or parse job queue file at {self.queue_file}: {e}")
-            # Attempt to reset the file to a clean state
-            with open(self.queue_file, 'w') as f:
-                json.dump({'jobs': []}, f, indent=4)
+                    self._sync()
+                except _JSON_ERRORS:
+                    corrupt_file = f"{self.wal_file}.corrupt-{suffix}"
+                    shutil.copyfile(self.wal_file, corrupt_file)
+                    # Keep every record before the bad one. The WAL is truncated rather than
+                    # replaced because other processes hold it open.
+                    _write_atomic(self.queue_file, _dumps({'generation': self._generation + 1, 'jobs': self._jobs}))
+                    self._reset_wal(self._generation + 1)
+                    log.warning("Copied unreadable job queue WAL to %s; records after the bad one were dropped.", corrupt_file)
+                self._generation = None
+        except (IOError, *_JSON_ERRORS) as e:
+            log.error("Could not recover job queue file at %s: %s", self.queue_file, e)
+            self._generation = None
+
+    def _execute_with_shared_lock(self, operation):
+        """Performs a read-only operation on the job queue; readers do not block each other."""
+        try:
+            with self._locked(shared=True):
+                self._sync(exclusive=False)
+                return operation(self._jobs)
+        except (IOError, *_JSON_ERRORS) as e:
+            log.error("Could not access or parse job queue file at %s: %s", self.queue_file, e)
+            self._generation = None
             return None
 
+    def _create_job(self, input_path, job_type):
+        """Creates and indexes a new job. Returns False if the job already exists or the type is unknown."""
+        if input_path in self._by_path:
+            return False # Job already exists
+
+        template = _STEPS_TEMPLATES.get(job_type)
+        if template is None:
+            log.error("Unknown job type '%s' for %s", job_type, input_path)
+            return False
+
+        new_job = {
+            'id': str(uuid.uuid4()),
+            'input_path': input_path,
+            'job_type': job_type,
+            'status': 'pending',
+            'worker_id': None,
+            'output_path': None,
+            'added_at': time.time(),
+            'retries': 0,
+            'steps': dict(template)
+        }
+        self._mark_dirty(self._put(new_job))
+        return True
+
     def add_job(self, input_path, job_type):
         """Adds a new job to the queue with a specific type if it doesn't already exist."""
-        def _add_job_op(queue):
-            if any(j.get('input_path') == input_path for j in queue['jobs']):
-                return False # Job already exists
-
-            if job_type == 'dolby_vision':
-                steps = {
-                    'copy_source': 'pending',
-                    'get_metadata': 'pending',
-                    'extract_p7': 'pending',
-                    'convert_p8': 'pending',
-                    'extract_rpu': 'pending',
-                    'reencode_x265': 'pending',
-                    'inject_rpu': 'pending',
-                    'remux_final': 'pending',
-                    'move_final': 'pending'
-                }
-            elif job_type == 'standard':
-                # The re-encode step will now also handle muxing for standard jobs
-                steps = {
-                    'copy_source': 'pending',
-                    'get_metadata': 'pending',
-                    'reencode_x265': 'pending',
-                    'move_final': 'pending'
-                }
-            else:
-                print(f"ERROR: Unknown job type '{job_type}' for {input_path}")
-                return False
-
-            new_job = {
-                'id': str(uuid.uuid4()),
-                'input_path': input_path,
-                'job_type': job_type,
-                'status': 'pending',
-                'worker_id': None,
-                'output_path': None,
-                'added_at': time.time(),
-                'retries': 0,
-                'steps': steps
-            }
-            queue['jobs'].append(new_job)
-            return True
+        def _add_job_op(jobs):
+            return self._create_job(input_path, job_type)
         return self._execute_with_lock(_add_job_op)
 
-    def claim_next_available_job(self, worker_id, max_retries=3):
+    def add_jobs(self, new_jobs):
+        """
+        Adds several (input_path, job_type) jobs under a single lock acquisition and WAL write.
+        Returns a list with one boolean per job, as add_job would have returned.
+        """
+        new_jobs = list(new_jobs)
+        def _add_jobs_op(jobs):
+            return [self._create_job(input_path, job_type) for input_path, job_type in new_jobs]
+        return self._execute_with_lock(_add_jobs_op) or [False] * len(new_jobs)
+
+    def claim_next_available_job(self, worker_id, max_retries=MAX_RETRIES):
         """Finds the next available job that hasn't exceeded max_retries, marks it as 'running', and returns it."""
-        def _get_and_update_op(queue):
-            # First, quarantine any jobs that have failed too many times.
-            for job in queue['jobs']:
-                if job.get('status') == 'failed' and job.get('retries', 0) >= max_retries:
-                    job['status'] = 'failed_permanent'
-                    print(f"Job {job['id']} has failed {job.get('retries', 0)} times and is now permanently failed.")
-
-            # Now, find the next available job to run.
-            for job in sorted(queue['jobs'], key=lambda j: j['added_at']):
-                if job.get('status') in ['pending', 'failed']:
+        def _get_and_update_op(jobs):
+            # Pending jobs are served oldest first, then failed jobs in the order they failed.
+            for queue, expected_status in ((self._pending, 'pending'), (self._failed, 'failed')):
+                while queue:
+                    job = self._by_id.get(queue.popleft())
+                    if job is None or job.get('status') != expected_status:
+                        continue # Stale entry, the job has moved on since it was queued
+
+                    # Quarantine jobs that have failed too many times.
+                    if expected_status == 'failed' and job.get('retries', 0) >= max_retries:
+                        job['status'] = 'failed_permanent'
+                        self._mark_fields_dirty(job, 'status')
+                        log.warning("Job %s has failed %s times and is now permanently failed.", job['id'], job.get('retries', 0))
+                        continue
+
                     job['status'] = 'running'
                     job['worker_id'] = worker_id
                     job['claimed_at'] = time.time()
                     job['retries'] = job.get('retries', 0) + 1
-                    return job
+                    self._mark_fields_dirty(job, 'status', 'worker_id', 'claimed_at', 'retries')
+                    return copy.deepcopy(job)
             return None
         return self._execute_with_lock(_get_and_update_op)
 
+    def claim_job(self, worker_id, job_id=None, input_path=None):
+        """Assigns a specific job (by job_id or input_path) to a worker without changing its status, and returns it."""
+        def _claim_op(jobs):
+            job = self._by_id.get(job_id) if job_id else self._by_path.get(input_path)
+            if job is None:
+                return None
+            job['worker_id'] = worker_id
+            job['claimed_at'] = time.time()
+            self._mark_fields_dirty(job, 'worker_id', 'claimed_at')
+            return copy.deepcopy(job)
+        return self._execute_with_lock(_claim_op)
+
     def update_job_status(self, job_id, status, output_path=None):
         """Updates the status and output path of a specific job by its ID."""
-        def _update_job_op(queue):
-            for job in queue['jobs']:
-                if job.get('id') == job_id:
-                    job['status'] = status
-                    if output_path:
-                        job['output_path'] = output_path
-                    job['completed_at'] = time.time()
-                    return True
-            return False
+        def _update_job_op(jobs):
+            job = self._by_id.get(job_id)
+            if job is None:
+                return False
+            self._set_status(job, status)
+            if output_path:
+                job['output_path'] = output_path
+            job['completed_at'] = time.time()
+            # A status flip only logs the handful of fields it changed, not the whole record
+            self._mark_fields_dirty(job, 'status', 'output_path', 'completed_at')
+            return True
         return self._execute_with_lock(_update_job_op)
 
     def update_job_step_status(self, job_id, step, status):
         """Updates the status of a specific step within a job."""
-        def _update_step_op(queue):
-            for job in queue['jobs']:
-                if job.get('id') == job_id:
-                    if 'steps' in job and step in job['steps']:
-                        job['steps'][step] = status
-                        return True
+        def _update_step_op(jobs):
+            job = self._by_id.get(job_id)
+            if job is not None and 'steps' in job and step in job['steps']:
+                if job['steps'][step] != status:
+                    job['steps'][step] = status
+                    self._mark_step_dirty(job, step)
+                return True
             return False
         return self._execute_with_lock(_update_step_op)
 
+    def update_job_metadata(self, job_id, metadata):
+        """Stores the probed video metadata of a job, so that resumed runs can skip probing."""
+        def _update_metadata_op(jobs):
+            job = self._by_id.get(job_id)
+            if job is None:
+                return False
+            if job.get('metadata') != metadata:
+                job['metadata'] = metadata
+                self._mark_fields_dirty(job, 'metadata')
+            return True
+        return self._execute_with_lock(_update_metadata_op)
+
     def get_all_file_paths(self):
         """Returns a set of all input_paths currently in the queue."""
-        def _get_paths_op(queue):
-            return {job.get('input_path') for job in queue.get('jobs', [])}
-        return self._execute_with_lock(_get_paths_op)
+        def _get_paths_op(jobs):
+            return set(self._by_path)
+        return self._execute_with_shared_lock(_get_paths_op)
+
+    def get_job(self, job_id=None, input_path=None):
+        """Returns a copy of a specific job (by job_id or input_path), or None if it is not in the queue."""
+        def _get_job_op(jobs):
+            job = self._by_id.get(job_id) if job_id else self._by_path.get(input_path)
+            return copy.deepcopy(job) if job is not None else None
+        return self._execute_with_shared_lock(_get_job_op)
+
+    def _reset_job(self, job, from_step_index):
+        """Resets a job's steps from from_step_index onwards and makes it claimable again."""
+        # Reset the status of the target step and all subsequent steps
+        for step_name in STEP_ORDER[from_step_index - 1:]:
+            if step_name in job.get('steps', {}) and job['steps'][step_name] != 'pending':
+                job['steps'][step_name] = 'pending'
+                self._mark_step_dirty(job, step_name)
+
+        # Reset job status and retries to allow re-processing, even if previously permanently failed
+        if job.get('status') != 'failed' or job.get('retries'):
+            self._set_status(job, 'failed')
+            job['retries'] = 0
+            self._mark_fields_dirty(job, 'status', 'retries')
 
     def reset_job_progress(self, job_id, from_step_index):
         """Resets the progress of a job from a specific step index."""
-        step_order = [
-            'copy_source',
-            'get_metadata',
-            'extract_p7',
-            'convert_p8',
-            'extract_rpu',
-            'reencode_x265',
-            'inject_rpu',
-            'remux_final',
-            'move_final'
-        ]
-
-        if not (1 <= from_step_index <= len(step_order)):
-            print(f"Error: Invalid step index {from_step_index}. Must be between 1 and {len(step_order)}.")
+        if not (1 <= from_step_index <= len(STEP_ORDER)):
+            log.error("Invalid step index %s. Must be between 1 and %s.", from_step_index, len(STEP_ORDER))
             return False
 
-        def _reset_op(queue):
-            for job in queue['jobs']:
-                if job.get('id') == job_id:
-                    # Reset the status of the target step and all subsequent steps
-                    for i in range(from_step_index - 1, len(step_order)):
-                        step_name = step_order[i]
-                        if step_name in job.get('steps', {}):
-                            job['steps'][step_name] = 'pending'
-                    
-                    # Reset job status and retries to allow re-processing, even if previously permanently failed
-                    if job.get('status') == 'failed_permanent':
-                        print(f"[ADMIN] Job {job['id']} was permanently failed but is being reset for re-run.")
-                    job['status'] = 'failed'
-                    job['retries'] = 0
-                    return True
-            return False
+        def _reset_op(jobs):
+            job = self._by_id.get(job_id)
+            if job is None:
+                return False
+            if job.get('status') == 'failed_permanent':
+                log.warning("[ADMIN] Job %s was permanently failed but is being reset for re-run.", job['id'])
+            self._reset_job(job, from_step_index)
+            return True
         return self._execute_with_lock(_reset_op)
 
     def force_reset_job_progress(self, job_id=None, input_path=None, from_step_index=1):
         """Forcefully resets a job's progress and status by job_id or input_path, regardless of its current status."""
-        step_order = [
-            'copy_source',
-            'get_metadata',
-            'extract_p7',
-            'convert_p8',
-            'extract_rpu',
-            'reencode_x265',
-            'inject_rpu',
-            'remux_final',
-            'move_final'
-        ]
-        if not (1 <= from_step_index <= len(step_order)):
-            print(f"Error: Invalid step index {from_step_index}. Must be between 1 and {len(step_order)}.")
-            return False
-        def _force_reset_op(queue):
-            for job in queue['jobs']:
-                if (job_id and job.get('id') == job_id) or (input_path and job.get('input_path') == input_path):
-                    for i in range(from_step_index - 1, len(step_order)):
-                        step_name = step_order[i]
-                        if step_name in job.get('steps', {}):
-                            job['steps'][step_name] = 'pending'
-                    print(f"[ADMIN] Force-resetting job {job['id']} (status was: {job.get('status')}) for re-run from step {from_step_index}.")
-                    job['status'] = 'failed'
-                    job['retries'] = 0
-                    return True
+        if not (1 <= from_step_index <= len(STEP_ORDER)):
+            log.error("Invalid step index %s. Must be between 1 and %s.", from_step_index, len(STEP_ORDER))
             return False
+
+        def _force_reset_op(jobs):
+            job = self._by_id.get(job_id) if job_id else None
+            if job is None and input_path:
+                job = self._by_path.get(input_path)
+            if job is None:
+                return False
+            log.warning("[ADMIN] Force-resetting job %s (status was: %s) for re-run from step %s.", job['id'], job.get('status'), from_step_index)
+            self._reset_job(job, from_step_index)
+            return True
         return self._execute_with_lock(_force_reset_op)
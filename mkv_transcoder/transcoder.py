@@ -1,19 +1,187 @@
 import os
 import subprocess
 import logging
+import logging.handlers
+import atexit
+import errno
 import shutil
-import re
+import shlex
 import json
 import time
-import platform
 import sys
 import threading
-from queue import Queue, Empty
+import uuid
+from contextlib import contextmanager
+from functools import lru_cache
 
 from tqdm import tqdm
 
 from . import config
 
+# Chunk size for file copies; large enough to keep syscalls rare, small enough for a smooth progress bar
+_COPY_CHUNK = 8 * 1024 * 1024
+
+def _apply_progress(pbar, frame, progress):
+    """
+    Updates a progress bar at the 'progress=' line that ends each ffmpeg '-progress' block,
+    from the block's last 'frame=' value.
+    """
+    frame = frame.strip()
+    if frame.isdigit():
+        pbar.update(int(frame) - pbar.n)
+    if progress.strip() == b'end' and pbar.n:
+        # The total may only be an estimate from the duration; end the bar at the real count
+        pbar.total = pbar.n
+        pbar.refresh()
+
+def _fadvise(f, advice):
+    """Gives the kernel a caching hint for a whole open file, where the platform supports it."""
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, getattr(os, advice))
+        except OSError:
+            pass
+
+# Background deletions of finished jobs' staging directories, waited for at exit
+_reapers = []
+_reapers_lock = threading.Lock()
+
+@atexit.register
+def _join_reapers():
+    with _reapers_lock:
+        reapers = list(_reapers)
+    for reaper in reapers:
+        reaper.join()
+
+def _reap(path):
+    """Deletes a directory tree in a background thread that the process waits for at exit."""
+    reaper = threading.Thread(target=shutil.rmtree, args=(path,), kwargs={'ignore_errors': True}, daemon=True)
+    reaper.start()
+    with _reapers_lock:
+        _reapers[:] = [r for r in _reapers if r.is_alive()] + [reaper]
+
+def sweep_trash_dirs():
+    """
+    Deletes, in the background, staging directories that were moved aside for deletion by a
+    worker that was killed before it finished. Returns how many there were.
+    """
+    try:
+        names = [name for name in os.listdir(config.STAGING_DIR) if '.trash-' in name]
+    except OSError:
+        return 0
+    for name in names:
+        _reap(os.path.join(config.STAGING_DIR, name))
+    return len(names)
+
+@lru_cache(maxsize=None)
+def _cpu_flags():
+    """Returns the CPU feature flags of this machine, read once from /proc/cpuinfo (Linux only)."""
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('flags'):
+                    return frozenset(line.split(':', 1)[1].split())
+    except OSError:
+        pass
+    return frozenset()
+
+@lru_cache(maxsize=None)
+def _which(name):
+    """Returns the absolute path of an external tool, looked up on PATH once per process."""
+    return shutil.which(name) or name
+
+def _argv(command):
+    """
+    Returns command with its program resolved to an absolute path, so PATH is searched once
+    per tool rather than on every spawn. Commands are spawned directly, not through a shell.
+    """
+    return [_which(command[0]), *command[1:]]
+
+def _encode_threads():
+    """Returns the number of threads one encode may use, sharing the cores between concurrent encodes."""
+    return max(1, (os.cpu_count() or 1) // config.MAX_CONCURRENT_ENCODES)
+
+# The P8.1 base layer is HDR10; say so explicitly, since not every encoder carries the input's
+# color description over to the output
+_HDR10_COLOR_ARGS = ("-color_primaries", "bt2020", "-color_trc", "smpte2084", "-colorspace", "bt2020nc")
+
+# Hardware encoders tried, in order, when config.ENCODER is 'auto'
+_HW_ENCODERS = ('hevc_nvenc', 'hevc_qsv', 'hevc_vaapi')
+
+@lru_cache(maxsize=None)
+def _encoder_works(input_args, output_args):
+    """
+    Returns whether ffmpeg can encode with the given encoder arguments on this machine. An
+    encoder being listed by 'ffmpeg -encoders' only means ffmpeg was built with it, so this
+    encodes one test frame instead.
+    """
+    command = ["ffmpeg", "-v", "error", "-hide_banner", *input_args, "-f", "lavfi", "-i", "testsrc2=size=1280x720:rate=24",
+               "-frames:v", "1", *output_args, "-f", "null", "-"]
+    try:
+        return subprocess.run(_argv(command), capture_output=True, timeout=60).returncode == 0
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+
+# Bytes of RAM disk promised to the HEVC intermediates of this process's jobs in progress,
+# which statvfs doesn't count until they are written
+_ram_reserved = 0
+_ram_reserved_lock = threading.Lock()
+
+# Files a job may keep on the RAM disk, named after the job ID. The worker only removes them
+# once a job is finished with, since they let a retried job resume.
+_RAM_FILE_SUFFIXES = ('_video_p8.hevc', '_video_final_with_rpu.hevc', '_rpu.bin')
+
+def remove_ram_files(job_id):
+    """Removes a job's files from the RAM disk. Returns the paths removed."""
+    removed = []
+    for suffix in _RAM_FILE_SUFFIXES:
+        path = os.path.join(config.RAM_TEMP_DIR, f"{job_id}{suffix}")
+        try:
+            os.remove(path)
+            removed.append(path)
+        except FileNotFoundError:
+            pass
+    return removed
+
+def sweep_ram_files(job_queue):
+    """
+    Removes RAM disk files left by jobs that will never run again: jobs that are done,
+    permanently failed, or gone from the queue. Returns the paths removed.
+    """
+    try:
+        names = os.listdir(config.RAM_TEMP_DIR)
+    except OSError:
+        return []
+    job_ids = set()
+    for name in names:
+        for suffix in _RAM_FILE_SUFFIXES:
+            if name.endswith(suffix):
+                job_id = name[:-len(suffix)]
+                try:
+                    # Job IDs are UUIDs; leave anything else on the RAM disk alone
+                    uuid.UUID(job_id)
+                except ValueError:
+                    continue
+                job_ids.add(job_id)
+    removed = []
+    for job_id in job_ids:
+        job = job_queue.get_job(job_id=job_id)
+        if job is None or job.get('status') in ('done', 'failed_permanent'):
+            removed += remove_ram_files(job_id)
+    return removed
+
+# The x265 encode saturates the CPU on its own; other steps of concurrent jobs don't.
+# Each running encode holds one numbered slot, which picks its cores when PIN_ENCODES is set.
+_encode_slots = threading.BoundedSemaphore(config.MAX_CONCURRENT_ENCODES)
+_free_encode_slots = list(range(config.MAX_CONCURRENT_ENCODES))
+_free_encode_slots_lock = threading.Lock()
+
+def _slot_cpus(slot):
+    """Returns the share of this process's CPUs that belongs to an encode slot."""
+    cpus = sorted(os.sched_getaffinity(0))
+    count = config.MAX_CONCURRENT_ENCODES
+    return set(cpus[slot * len(cpus) // count:(slot + 1) * len(cpus) // count]) or set(cpus)
+
 
 class Transcoder:
     def __init__(self, job, job_queue):
@@ -26,16 +194,46 @@ class Transcoder:
         self.job_staging_dir = os.path.join(config.STAGING_DIR, self.job_id)
         os.makedirs(self.job_staging_dir, exist_ok=True)
 
-        self.local_source_path = os.path.join(self.job_staging_dir, os.path.basename(self.original_input_path))
-
-        self.p7_video_path = os.path.join(self.job_staging_dir, 'video_p7.hevc')
-        self.p8_video_path = os.path.join(self.job_staging_dir, 'video_p8.hevc')
-        self.rpu_path = os.path.join(self.job_staging_dir, 'rpu.bin')
-        self.reencoded_video_path = os.path.join(self.job_staging_dir, 'video_reencoded.hevc')
-        self.final_video_with_rpu_path = os.path.join(self.job_staging_dir, 'video_final_with_rpu.hevc')
+        if config.READ_SOURCE_IN_PLACE:
+            self.local_source_path = self.original_input_path
+        else:
+            self.local_source_path = os.path.join(self.job_staging_dir, os.path.basename(self.original_input_path))
+
+        # The HEVC intermediates are each written once and read back once, so they go to the RAM
+        # disk as well when it comfortably fits them. Intermediates an earlier run left in the
+        # staging directory stay there, so that a resumed job doesn't redo its steps. The final
+        # MKV always goes to disk.
+        self._ram_reservation = 0
+        staging_intermediates = (os.path.join(self.job_staging_dir, 'video_p8.hevc'),
+                                 os.path.join(self.job_staging_dir, 'video_final_with_rpu.hevc'))
+        ram_intermediates = (os.path.join(config.RAM_TEMP_DIR, f"{self.job_id}_video_p8.hevc"),
+                             os.path.join(config.RAM_TEMP_DIR, f"{self.job_id}_video_final_with_rpu.hevc"))
+        use_ram = (job.get('job_type') == 'dolby_vision'
+                   and not any(os.path.exists(path) for path in staging_intermediates)
+                   and self._reserve_ram_for_intermediates(ram_intermediates))
+        if not use_ram:
+            # An earlier run's intermediates in RAM won't be used; don't leave them pinned there
+            for path in ram_intermediates:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        self.p8_video_path, self.final_video_with_rpu_path = ram_intermediates if use_ram else staging_intermediates
+        # The RPU is small and only read by the encode step, so keep it in RAM when the VM has a
+        # RAM disk. It is checked for like any other step output, so losing it to a reboot just
+        # reruns convert_p8.
+        if os.path.isdir(config.RAM_TEMP_DIR):
+            self.rpu_path = os.path.join(config.RAM_TEMP_DIR, f"{self.job_id}_rpu.bin")
+        else:
+            self.rpu_path = os.path.join(self.job_staging_dir, 'rpu.bin')
+        self.track_stash_path = os.path.join(self.job_staging_dir, 'audio_subs.mks')
 
         self.total_frames = None
         self.frame_rate = None
+        # Index of the main video stream among the video streams (for '0:v:N' maps)
+        self.video_stream = None
+        # CPUs of the encode slot held while encoding: None outside an encode, empty if not pinned
+        self._encode_cpus = None
         
         output_filename = f"{self.base_filename}_DV_P8.mkv"
         self.local_output_path = os.path.join(self.job_staging_dir, output_filename)
@@ -47,11 +245,42 @@ class Transcoder:
         self.logger = self._setup_logger()
         self._log_initial_paths()
 
+    def _reserve_ram_for_intermediates(self, paths):
+        """
+        Reserves RAM disk space for what is still to be written of the HEVC intermediates at paths
+        (each about the size of the source), if the RAM disk has room for it with a wide margin
+        after what concurrent jobs have already reserved. Returns whether the intermediates go to
+        the RAM disk.
+        """
+        global _ram_reserved
+        try:
+            st = os.statvfs(config.RAM_TEMP_DIR)
+            source_size = os.path.getsize(self.original_input_path)
+            # What an earlier run already wrote there is counted as used by statvfs
+            needed = sum(max(0, source_size - (os.path.getsize(path) if os.path.exists(path) else 0)) for path in paths)
+        except (OSError, AttributeError):
+            # No RAM disk, or no statvfs (Windows)
+            return False
+        with _ram_reserved_lock:
+            if needed and needed + _ram_reserved >= 0.6 * st.f_bavail * st.f_frsize:
+                return False
+            _ram_reserved += needed
+            self._ram_reservation = needed
+        return True
+
+    def _release_ram_reservation(self):
+        """Returns this job's RAM disk reservation; once the job stops, statvfs counts what it left there."""
+        global _ram_reserved
+        with _ram_reserved_lock:
+            _ram_reserved -= self._ram_reservation
+            self._ram_reservation = 0
+
     def _log_initial_paths(self):
         self.logger.info(f"Job {self.job_id} initialized.")
         self.logger.info(f"Original input file: {self.original_input_path}")
         self.logger.info(f"Final output file: {self.output_path}")
         self.logger.info(f"Local job staging directory: {self.job_staging_dir}")
+        self.logger.info(f"HEVC intermediates directory: {os.path.dirname(self.p8_video_path)}")
         self._log_disk_space(config.STAGING_DIR, "Local Staging SSD")
 
     def _log_disk_space(self, path, description):
@@ -70,12 +299,29 @@ class Transcoder:
         logger = logging.getLogger(f"transcoder_{self.job_id}")
         logger.setLevel(logging.INFO)
         if not logger.handlers:
-            fh = logging.FileHandler(self.log_file, mode='a')  # APPEND mode
+            # APPEND mode; the file is only opened once the first batch of records is written
+            fh = logging.FileHandler(self.log_file, mode='a', delay=True)
             formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
             fh.setFormatter(formatter)
-            logger.addHandler(fh)
+            # Buffer records and write them in batches rather than one write per record;
+            # errors are written out immediately, and the rest at the end of transcode()
+            mh = logging.handlers.MemoryHandler(1024, flushLevel=logging.ERROR, target=fh)
+            logger.addHandler(mh)
         return logger
 
+    def _flush_log(self):
+        """
+        Writes out the buffered log records and detaches the job's log file from its logger,
+        so a long-running worker doesn't keep the handlers of every job it has run.
+        """
+        for handler in list(self.logger.handlers):
+            target = getattr(handler, 'target', None)
+            self.logger.removeHandler(handler)
+            # Closing the MemoryHandler writes out its buffer, but leaves its target open
+            handler.close()
+            if target:
+                target.close()
+
     def _copy_with_progress(self, src, dst, description):
         self.logger.info(f"{description}: from {src} to {dst}")
         print(f"- {description}...")
@@ -84,12 +330,23 @@ class Transcoder:
             with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst, tqdm(
                 total=file_size, unit='B', unit_scale=True, unit_divisor=1024, desc=description, bar_format='{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}]'
             ) as pbar:
-                while True:
-                    buf = fsrc.read(1024 * 1024)
-                    if not buf:
-                        break
-                    fdst.write(buf)
-                    pbar.update(len(buf))
+                # Read-ahead hint for the whole file; the source won't be read again, so drop
+                # it from the page cache afterwards instead of evicting the encode's data
+                _fadvise(fsrc, 'POSIX_FADV_SEQUENTIAL')
+                if not self._copy_in_kernel(fsrc, fdst, pbar):
+                    # One reusable buffer, so the loop allocates nothing per chunk
+                    buf = memoryview(bytearray(_COPY_CHUNK))
+                    while True:
+                        n = fsrc.readinto(buf)
+                        if not n:
+                            break
+                        fdst.write(buf[:n])
+                        pbar.update(n)
+                fdst.flush()
+                copied, expected = os.fstat(fdst.fileno()).st_size, os.fstat(fsrc.fileno()).st_size
+                if copied != expected:
+                    raise IOError(f"copied {copied} of {expected} bytes")
+                _fadvise(fsrc, 'POSIX_FADV_DONTNEED')
             self.logger.info("Copy successful.")
             print(f"\n- {description} successful.")
             return True
@@ -98,11 +355,68 @@ class Transcoder:
             print(f"\n- {description} failed. Check logs.")
             return False
 
+    def _copy_in_kernel(self, fsrc, fdst, pbar):
+        """
+        Copies the rest of fsrc to fdst without passing the data through Python: with
+        copy_file_range where the two filesystems allow it, otherwise with sendfile.
+        Returns False if neither works for these files, leaving the rest to the caller.
+        """
+        in_fd, out_fd = fsrc.fileno(), fdst.fileno()
+        size = os.fstat(in_fd).st_size
+        copiers = []
+        if hasattr(os, 'copy_file_range'):
+            copiers.append(('copy_file_range', lambda: os.copy_file_range(in_fd, out_fd, _COPY_CHUNK)))
+        if hasattr(os, 'sendfile'):
+            copiers.append(('sendfile', lambda: os.sendfile(out_fd, in_fd, None, _COPY_CHUNK)))
+        for name, copy in copiers:
+            try:
+                while True:
+                    copied = copy()
+                    if not copied:
+                        break
+                    pbar.update(copied)
+                if os.lseek(in_fd, 0, os.SEEK_CUR) >= size:
+                    return True
+                # Some filesystems (FUSE and CIFS mounts among them) report end of file early
+                # instead of failing
+                self.logger.debug(f"{name} stopped short of the end of the file, falling back.")
+            except OSError as e:
+                # Both calls advance the shared file offsets, so the next method picks up
+                # wherever this one stopped
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP):
+                    raise
+                self.logger.debug(f"{name} unavailable for this copy ({e}), falling back.")
+        return False
+
+    def _drop_from_cache(self, *paths):
+        """Drops files that later steps won't read again from the page cache (no-op on the RAM disk)."""
+        for path in paths:
+            try:
+                with open(path, 'rb') as f:
+                    _fadvise(f, 'POSIX_FADV_DONTNEED')
+            except OSError:
+                pass
+
     def _move_final_file(self, src, dst):
         self.logger.info(f"Moving final file from {src} to {dst}")
         print(f"- Moving final file to destination...")
         try:
-            shutil.move(src, dst)
+            try:
+                os.replace(src, dst)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                # Staging and the destination are on different filesystems. Copy in the kernel,
+                # with progress, under a temporary name so that the final name only appears
+                # once the file is complete.
+                partial_path = f"{dst}.partial"
+                if not self._copy_with_progress(src, partial_path, "Copying final file to destination"):
+                    if os.path.exists(partial_path):
+                        os.remove(partial_path)
+                    print("  Failed. Check logs.")
+                    return False
+                os.replace(partial_path, dst)
+                os.remove(src)
             self.logger.info("Move successful.")
             print("  Done.")
             return True
@@ -113,33 +427,18 @@ class Transcoder:
 
     def _run_command(self, command, step_name):
         self.logger.info(f"{step_name}...")
-        self.logger.info(f"Executing command: {' '.join(command)}")
+        self.logger.info("Executing command: %s", shlex.join(command))
         print(f"- {step_name}...")
+        # The tool's output goes straight into a side log file next to the job log (mkvmerge
+        # reports errors on stdout, so both streams), and its tail is logged if it fails
+        output_log = f"{os.path.splitext(self.log_file)[0]}.{os.path.basename(command[0])}.log"
         try:
-            process = subprocess.Popen(' '.join(command), stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8', shell=True)
-
-            # Thread to consume stdout to prevent blocking
-            def consume_stdout():
-                with process.stdout:
-                    for line in iter(process.stdout.readline, ''):
-                        self.logger.debug(f"STDOUT: {line.strip()}")
-
-            stdout_thread = threading.Thread(target=consume_stdout)
-            stdout_thread.start()
-
-            # Read stderr line by line and log/print it in real-time
-            with process.stderr:
-                for line in iter(process.stderr.readline, ''):
-                    line = line.strip()
-                    if line:
-                        self.logger.error(line)
-                        print(line, file=sys.stderr)
-
-            stdout_thread.join()
-            process.wait()
-
-            if process.returncode != 0:
-                self.logger.error(f"{step_name} failed with exit code {process.returncode}.")
+            with open(output_log, 'wb') as output:
+                returncode = subprocess.call(_argv(command), stdout=output, stderr=subprocess.STDOUT)
+
+            if returncode != 0:
+                self.logger.error(f"{step_name} failed with exit code {returncode}. Last output (full output in {output_log}):")
+                self._log_output_tail(output_log)
                 print(f"- {step_name} failed. Check logs for details.")
                 return False
 
@@ -147,106 +446,163 @@ class Transcoder:
             print(f"- {step_name} successful.")
             return True
         except Exception as e:
-            self.logger.error(f"An unexpected error occurred while running command: {' '.join(command)}", exc_info=True)
+            self.logger.error(f"An unexpected error occurred while running command: {shlex.join(command)}", exc_info=True)
             print(f"- {step_name} failed with an unexpected error. Check logs.")
             return False
 
+    def _source_signature(self, video_path):
+        st = os.stat(video_path)
+        return [st.st_size, st.st_mtime_ns]
+
+    def _load_cached_metadata(self, video_path):
+        """Restores the metadata probed by an earlier run of this job, if the file hasn't changed since."""
+        metadata = self.job.get('metadata')
+        try:
+            if not metadata or 'video_stream' not in metadata or metadata.get('source') != self._source_signature(video_path):
+                return False
+        except OSError:
+            return False
+        self.total_frames = metadata['total_frames']
+        self.frame_rate = metadata['frame_rate']
+        self.video_stream = metadata['video_stream']
+        self.logger.info(f"Using cached video metadata: {self.total_frames} frames at {self.frame_rate:.3f} fps.")
+        return True
+
     def _get_video_metadata(self, video_path):
         """Gets video metadata using specific ffprobe commands and stores it in instance variables."""
+        if self._load_cached_metadata(video_path):
+            return True
         self.logger.info(f"Attempting to get video metadata from {video_path}")
         total_frames = None
         frame_rate = None
+        video_stream = None
 
-        # Method 1: Get avg_frame_rate
+        # Method 1: Find the main video stream and read its frame rate, frame count tags,
+        # nb_frames and the durations in a single ffprobe call. This only reads the headers,
+        # so it's instant.
         try:
-            command = ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "stream=avg_frame_rate", "-of", "default=noprint_wrappers=1:nokey=1", f'"{video_path}"']
-            result = subprocess.run(' '.join(command), capture_output=True, text=True, check=True, shell=True)
-            output = result.stdout.strip()
-            if '/' in output:
-                num, den = map(int, output.split('/'))
-                frame_rate = num / den
-                self.logger.info(f"Successfully got frame rate: {frame_rate:.3f} fps.")
-        except (subprocess.CalledProcessError, ValueError, IndexError) as e:
-            self.logger.warning(f"Could not get avg_frame_rate. Error: {e}")
+            command = ["ffprobe", "-v", "error", "-select_streams", "v", "-show_entries", "stream=avg_frame_rate,nb_frames,duration:stream_disposition=attached_pic:stream_tags:format=duration", "-of", "json", video_path]
+            result = subprocess.run(_argv(command), capture_output=True, text=True, check=True)
+            data = json.loads(result.stdout)
+            streams = data['streams']
+            # The main video stream is the first one that isn't an attached picture (cover art)
+            main_streams = [i for i, s in enumerate(streams) if not s.get('disposition', {}).get('attached_pic')]
+            if not main_streams:
+                self.logger.warning("All video streams are attached pictures; falling back to the first one.")
+            video_stream = main_streams[0] if main_streams else 0
+            stream = streams[video_stream]
+            self.logger.info(f"Found main video stream: v:{video_stream}")
+            num, den = map(int, stream['avg_frame_rate'].split('/'))
+            frame_rate = num / den
+            self.logger.info(f"Successfully got frame rate: {frame_rate:.3f} fps.")
+
+            tags = stream.get('tags', {})
+            for tag in ["NUMBER_OF_FRAMES-eng", "NUMBER_OF_FRAMES"]:
+                if str(tags.get(tag, '')).isdigit():
+                    total_frames = int(tags[tag])
+                    self.logger.info(f"Successfully got frame count from tag '{tag}': {total_frames} frames.")
+                    break
+            if not total_frames and str(stream.get('nb_frames', '')).isdigit():
+                total_frames = int(stream['nb_frames'])
+                self.logger.info(f"Successfully got frame count from stream: {total_frames} frames.")
+            if not total_frames:
+                # The frame count only sizes the progress bars, so an estimate from the duration
+                # is close enough. The stream's own duration is usually missing in MKV.
+                duration = stream.get('duration') or data.get('format', {}).get('duration')
+                if duration and duration != 'N/A':
+                    total_frames = round(float(duration) * frame_rate)
+                    self.logger.info(f"Estimated frame count from duration ({float(duration):.3f}s): {total_frames} frames.")
+        except (subprocess.CalledProcessError, json.JSONDecodeError, KeyError, ValueError, IndexError, ZeroDivisionError) as e:
+            self.logger.warning(f"Could not read video metadata. Error: {e}")
             if isinstance(e, subprocess.CalledProcessError):
-                self.logger.warning(f"ffprobe (frame rate) stdout: {e.stdout}")
-                self.logger.warning(f"ffprobe (frame rate) stderr: {e.stderr}")
+                self.logger.warning(f"ffprobe stdout: {e.stdout}")
+                self.logger.warning(f"ffprobe stderr: {e.stderr}")
 
-        # Method 2: Get frame count from tags
-        for tag in ["NUMBER_OF_FRAMES-eng", "NUMBER_OF_FRAMES"]:
-            try:
-                command = ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", f"stream_tags={tag}", "-of", "default=noprint_wrappers=1:nokey=1", f'"{video_path}"']
-                result = subprocess.run(' '.join(command), capture_output=True, text=True, check=True, shell=True)
-                output = result.stdout.strip()
-                if output.isdigit():
-                    total_frames = int(output)
-                    self.logger.info(f"Successfully got frame count from tag '{tag}': {total_frames} frames.")
-                    break # Exit loop on success
-            except (subprocess.CalledProcessError, ValueError, IndexError) as e:
-                self.logger.warning(f"Could not get frame count from tag '{tag}'. Error: {e}")
-                if isinstance(e, subprocess.CalledProcessError):
-                    self.logger.warning(f"ffprobe (tag: {tag}) stdout: {e.stdout}")
-                    self.logger.warning(f"ffprobe (tag: {tag}) stderr: {e.stderr}")
-        
-        # Method 3: Fallback to counting frames manually if tags fail
+        # Method 2: Fall back to counting packets. This demuxes the whole file but, unlike
+        # -count_frames, doesn't decode it.
         if not total_frames:
-            self.logger.warning("Frame count tags failed. Falling back to manual frame counting.")
+            self.logger.warning("Falling back to counting packets.")
             try:
-                command = ["ffprobe", "-v", "error", "-select_streams", "v:0", "-count_frames", "-show_entries", "stream=nb_read_frames", "-of", "default=noprint_wrappers=1:nokey=1", f'"{video_path}"']
-                result = subprocess.run(' '.join(command), capture_output=True, text=True, check=True, shell=True)
+                command = ["ffprobe", "-v", "error", "-select_streams", f"v:{video_stream or 0}", "-count_packets", "-show_entries", "stream=nb_read_packets", "-of", "default=noprint_wrappers=1:nokey=1", video_path]
+                result = subprocess.run(_argv(command), capture_output=True, text=True, check=True)
                 output = result.stdout.strip()
                 if output.isdigit():
                     total_frames = int(output)
-                    self.logger.info(f"Successfully counted frames manually: {total_frames} frames.")
+                    self.logger.info(f"Successfully counted packets: {total_frames} frames.")
             except (subprocess.CalledProcessError, ValueError, IndexError) as e:
-                self.logger.error(f"Manual frame count failed. Error: {e}")
+                self.logger.error(f"Packet count failed. Error: {e}")
                 if isinstance(e, subprocess.CalledProcessError):
-                    self.logger.error(f"ffprobe (manual count) stdout: {e.stdout}")
-                    self.logger.error(f"ffprobe (manual count) stderr: {e.stderr}")
+                    self.logger.error(f"ffprobe (packet count) stdout: {e.stdout}")
+                    self.logger.error(f"ffprobe (packet count) stderr: {e.stderr}")
 
         if total_frames and frame_rate:
             self.total_frames = total_frames
             self.frame_rate = frame_rate
+            self.video_stream = video_stream
+            self.job['metadata'] = {'total_frames': total_frames, 'frame_rate': frame_rate, 'video_stream': video_stream, 'source': self._source_signature(video_path)}
+            self.job_queue.update_job_metadata(self.job_id, self.job['metadata'])
             return True
         else:
             self.logger.error("Failed to determine total frames or frame rate after all methods.")
             return False
 
+    def _pump_to_file(self, pipe, path):
+        """Copies a child process's output pipe into a file, in the kernel where possible."""
+        with pipe, open(path, 'wb') as out:
+            if hasattr(os, 'splice'):
+                try:
+                    while os.splice(pipe.fileno(), out.fileno(), 1 << 16):
+                        pass
+                    return
+                except OSError as e:
+                    # e.g. a filesystem that doesn't support splice; copy the rest the usual way
+                    self.logger.debug("os.splice unavailable for %s (%s), falling back to a copy loop.", path, e)
+            shutil.copyfileobj(pipe, out)
+
+    def _log_output_tail(self, path, lines=20):
+        """Logs the last lines of a captured output file as errors."""
+        try:
+            with open(path, 'rb') as f:
+                f.seek(max(0, os.fstat(f.fileno()).st_size - 16 * 1024))
+                tail = f.read().decode('utf-8', errors='replace').splitlines()[-lines:]
+        except OSError as e:
+            self.logger.error(f"Could not read captured output {path}: {e}")
+            return
+        for line in tail:
+            self.logger.error(line)
+            print(line, file=sys.stderr)
+
     def _run_ffmpeg_with_progress(self, command, total_frames, description):
-        self.logger.info(f"Executing ffmpeg command: {' '.join(command)}")
+        self.logger.info("Executing ffmpeg command: %s", shlex.join(command))
         print(f"- {description}...")
-        process = subprocess.Popen(' '.join(command), stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8', shell=True)
+        # Progress is read from '-progress' key=value lines on stdout rather than scraped from
+        # the stats line on stderr. stderr (including x265's own output) goes straight to a
+        # side log file next to the job log, and its tail is logged if the command fails.
+        progress_command = command[:1] + ['-progress', 'pipe:1', '-nostats'] + command[1:]
+        stderr_log = f"{os.path.splitext(self.log_file)[0]}.ffmpeg.log"
+        process = subprocess.Popen(_argv(progress_command), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self._tune_encoder(process)
         pbar = tqdm(total=total_frames, unit='frames', desc=description, bar_format='{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]')
 
-        # Consume stdout in a thread to prevent blocking
-        def consume_stdout():
-            with process.stdout:
-                for line in iter(process.stdout.readline, ''):
-                    self.logger.debug(f"STDOUT: {line.strip()}")
-        stdout_thread = threading.Thread(target=consume_stdout)
-        stdout_thread.start()
-
-        # Read stderr for progress and errors
-        with process.stderr:
-            for line in iter(process.stderr.readline, ''):
-                line = line.strip()
-                if not line:
-                    continue
-                match = re.search(r'frame=\s*(\d+)', line)
-                if match:
-                    frames_done = int(match.group(1))
-                    pbar.update(frames_done - pbar.n)
-                else:
-                    # If it's not a progress line, log it as an error
-                    self.logger.error(line)
-                    print(line, file=sys.stderr)
+        stderr_thread = threading.Thread(target=self._pump_to_file, args=(process.stderr, stderr_log))
+        stderr_thread.start()
+
+        with process.stdout:
+            frame = b''
+            for line in iter(process.stdout.readline, b''):
+                key, _, value = line.partition(b'=')
+                if key == b'frame':
+                    frame = value
+                elif key == b'progress':
+                    _apply_progress(pbar, frame, value)
 
         pbar.close()
-        stdout_thread.join()
+        stderr_thread.join()
         process.wait()
 
         if process.returncode != 0:
-            self.logger.error(f"{description} failed with exit code {process.returncode}.")
+            self.logger.error(f"{description} failed with exit code {process.returncode}. Last ffmpeg output (full output in {stderr_log}):")
+            self._log_output_tail(stderr_log)
             print(f"\n- {description} failed. Check logs.")
             return False
 
@@ -254,137 +610,235 @@ class Transcoder:
         print(f"- {description} successful.")
         return True
 
-    def _run_ffmpeg_copy_with_progress(self, command, total_frames, frame_rate, description):
-        self.logger.info(f"Executing ffmpeg stream copy: {' '.join(command)}")
+    def _run_pipeline(self, producer, consumers, total_frames, description):
+        """
+        Feeds the stdout of a producer command into the stdin of one or more consumer commands,
+        like a shell pipeline, so the stream between them never touches the disk. A single
+        consumer is connected with a plain OS pipe; several are fed by a tee thread. The
+        producer is an ffmpeg call; its progress is read from stderr ('-progress pipe:2').
+        """
+        # These commands run without a shell, so shlex.join shows the exact arguments
+        self.logger.info("Executing pipeline: %s | %s", shlex.join(producer), ' & '.join(map(shlex.join, consumers)))
         print(f"- {description}...")
-        progress_command = command[:1] + ['-progress', 'pipe:1', '-nostats'] + command[1:]
-
-        process = subprocess.Popen(
-            ' '.join(progress_command),
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=True,
-            bufsize=1,
-            encoding='utf-8',
-            shell=True
-        )
-
-        def _enqueue_output(pipe, queue):
-            for line in iter(pipe.readline, ''):
-                queue.put(line)
-            pipe.close()
-
-        stdout_queue = Queue()
-        stderr_queue = Queue()
-
-        stdout_thread = threading.Thread(target=_enqueue_output, args=(process.stdout, stdout_queue))
-        stderr_thread = threading.Thread(target=_enqueue_output, args=(process.stderr, stderr_queue))
-
-        stdout_thread.daemon = True
-        stderr_thread.daemon = True
-        stdout_thread.start()
-        stderr_thread.start()
-
+        commands = [producer] + list(consumers)
+        processes = []
+        threads = []
         pbar = tqdm(total=total_frames, desc=description, unit="frame")
-        last_frame = 0
-        error_lines = []
 
-        while process.poll() is None:
-            try:
-                while True:
-                    line = stdout_queue.get_nowait()
-                    if 'frame=' in line:
+        def drain_stderr(process, name):
+            frame = b''
+            for raw_line in iter(process.stderr.readline, b''):
+                # '-progress' key=value lines are parsed as bytes; only messages get decoded
+                key, sep, value = raw_line.partition(b'=')
+                if sep and b' ' not in key:
+                    if key == b'frame':
+                        frame = value
+                    elif key == b'progress':
+                        _apply_progress(pbar, frame, value)
+                    continue
+                line = raw_line.decode('utf-8', errors='replace').strip()
+                if line:
+                    self.logger.error(f"{name}: {line}")
+                    print(line, file=sys.stderr)
+            process.stderr.close()
+
+        def drain_stdout(process):
+            debug = self.logger.isEnabledFor(logging.DEBUG)
+            for raw_line in iter(process.stdout.readline, b''):
+                if debug:
+                    self.logger.debug("STDOUT: %s", raw_line.decode('utf-8', errors='replace').rstrip())
+            process.stdout.close()
+
+        def tee(source, sinks):
+            # One reusable buffer, filled and drained through the raw file descriptors, so
+            # each chunk is copied once into Python and once out to every consumer
+            buf = memoryview(bytearray(1024 * 1024))
+            sinks = list(sinks)
+            with source:
+                while sinks:
+                    n = source.raw.readinto(buf)
+                    if not n:
+                        break
+                    for sink in list(sinks):
+                        view = buf[:n]
                         try:
-                            parts = line.strip().split('=')
-                            if parts[0].strip() == 'frame':
-                                frame_num = int(parts[1])
-                                update_amount = frame_num - last_frame
-                                if update_amount > 0:
-                                    pbar.update(update_amount)
-                                    last_frame = frame_num
-                        except (ValueError, IndexError):
-                            continue
-            except Empty:
-                pass
-
+                            while view:
+                                view = view[os.write(sink.fileno(), view):]
+                        except OSError:
+                            # This consumer exited early; its exit code reports the failure
+                            sinks.remove(sink)
+                            close_quietly(sink)
+            for sink in sinks:
+                close_quietly(sink)
+
+        def close_quietly(pipe):
             try:
-                while True:
-                    line = stderr_queue.get_nowait()
-                    error_lines.append(line)
-            except Empty:
+                pipe.close()
+            except OSError:
                 pass
-            
-            time.sleep(0.1)
-
-        stdout_thread.join()
-        stderr_thread.join()
-
-        pbar.close()
 
-        if process.returncode != 0:
-            # Capture any final output from stderr
-            while not stderr_queue.empty():
-                error_lines.append(stderr_queue.get_nowait())
-
-            self.logger.error(f"ffmpeg copy failed with exit code {process.returncode} during '{description}'.")
-            filtered_errors = [line for line in error_lines if re.search(r'(error|invalid|no such file|failed)', line, re.IGNORECASE)]
-            if filtered_errors:
-                self.logger.error(f"Filtered ffmpeg error output:\n{''.join(filtered_errors)}")
+        try:
+            source = subprocess.Popen(_argv(producer), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            self._tune_encoder(source)
+            processes.append(source)
+            fan_out = len(consumers) > 1
+            for command in consumers:
+                processes.append(subprocess.Popen(_argv(command), stdin=subprocess.PIPE if fan_out else source.stdout,
+                                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE))
+            if fan_out:
+                threads.append(threading.Thread(target=tee, args=(source.stdout, [process.stdin for process in processes[1:]]), daemon=True))
             else:
-                self.logger.error(f"Full ffmpeg stderr (no specific error keywords found):\n{''.join(error_lines)}")
+                # Only the consumer should hold the read end, so that the producer gets SIGPIPE
+                # if the consumer exits early
+                source.stdout.close()
+            for command, process in zip(commands, processes):
+                threads.append(threading.Thread(target=drain_stderr, args=(process, command[0]), daemon=True))
+            for process in processes[1:]:
+                threads.append(threading.Thread(target=drain_stdout, args=(process,), daemon=True))
+            for thread in threads:
+                thread.start()
+
+            for process in processes:
+                process.wait()
+            for thread in threads:
+                thread.join()
+        except Exception:
+            self.logger.error(f"An unexpected error occurred while running pipeline for '{description}'", exc_info=True)
+            for process in processes:
+                if process.poll() is None:
+                    process.kill()
+            return False
+        finally:
+            pbar.close()
+
+        failed = [(command[0], process.returncode) for command, process in zip(commands, processes) if process.returncode != 0]
+        if failed:
+            for name, returncode in failed:
+                self.logger.error(f"{description} failed: {name} exited with code {returncode}.")
             print(f"\n- {description} failed. Check logs.")
             return False
 
         self.logger.info(f"Successfully completed: {description}")
+        print(f"- {description} successful.")
         return True
 
-    def _get_main_video_stream_index(self, video_path):
+    def _start_track_stash(self):
         """
-        Uses ffprobe to find the index of the main video stream.
-        The main video stream is determined as the one that is not an attached picture.
+        Starts copying the source's non-video tracks (with its chapters, tags and attachments)
+        into a small side file in the background. Returns the process, or None if it couldn't start.
         """
-        self.logger.info(f"Probing for main video stream in: {video_path}")
-        command = [
-            "ffprobe",
-            "-v", "error",
-            "-select_streams", "v:0",
-            "-show_entries", "stream=index,codec_type:stream_tags=attached_pic",
-            "-of", "json",
-            f'"{video_path}"'
-        ]
+        command = ["mkvmerge", "-o", self.track_stash_path, "--no-video", self.local_source_path]
+        self.logger.info("Extracting non-video tracks in the background: %s", shlex.join(command))
         try:
-            result = subprocess.run(' '.join(command), capture_output=True, text=True, check=True, encoding='utf-8', shell=True)
-            data = json.loads(result.stdout)
-            
-            video_streams = [s for s in data.get('streams', []) if s.get('codec_type') == 'video']
-            
-            # Filter out attached pictures (cover art)
-            main_streams = [s for s in video_streams if s.get('tags', {}).get('attached_pic', '0') == '0']
-
-            if not main_streams:
-                self.logger.error("No suitable video stream found (all might be attached pictures).")
-                # Fallback to first video stream if none are explicitly main
-                if video_streams:
-                    stream_index = video_streams[0]['index']
-                    self.logger.warning(f"Could not find a definitive main stream, falling back to first video stream at index: {stream_index}")
-                    return stream_index
-                return None
-
-            stream_index = main_streams[0]['index']
-            self.logger.info(f"Found main video stream at index: {stream_index}")
-            return stream_index
-
-        except (subprocess.CalledProcessError, json.JSONDecodeError, IndexError) as e:
-            self.logger.error(f"Failed to get main video stream index for {video_path}: {e}", exc_info=True)
+            return subprocess.Popen(_argv(command), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            self.logger.warning(f"Could not start extracting non-video tracks: {e}")
             return None
 
-    def _run_dovi_tool_with_progress(self, command, description):
-        # This function can now use the general-purpose _run_command
-        return self._run_command(command, description)
+    def _finish_track_stash(self, process):
+        """Waits for the background track extraction; returns whether its side file can be used."""
+        if process is None:
+            return False
+        # mkvmerge exits with 1 for warnings, which still means a complete file
+        returncode = process.wait()
+        if returncode not in (0, 1):
+            self.logger.warning(f"Extracting non-video tracks failed with exit code {returncode}; remuxing from the source instead.")
+            return False
+        return True
+
+    def _video_encoder(self):
+        """Returns the configured video encoder, resolving 'auto' to the first hardware encoder that works here."""
+        if config.ENCODER != 'auto':
+            return config.ENCODER
+        for encoder in _HW_ENCODERS:
+            input_args, output_args = self._encoder_args(encoder)
+            if _encoder_works(tuple(input_args), tuple(output_args)):
+                self.logger.info(f"Using hardware encoder {encoder}.")
+                return encoder
+        self.logger.info("No hardware encoder available; using libx265.")
+        return 'libx265'
+
+    def _encoder_args(self, encoder=None):
+        """
+        Returns the ffmpeg arguments for a video encoder (by default the configured one), as
+        (input_args, output_args): input_args go before '-i', output_args replace the codec options.
+        """
+        if encoder is None:
+            encoder = self._video_encoder()
+        if encoder == 'hevc_nvenc':
+            return [], ["-c:v", "hevc_nvenc", "-preset", "p6", "-tune", "hq", "-rc", "vbr", "-cq", "22", "-b:v", "0",
+                        "-profile:v", "main10", "-pix_fmt", "p010le", "-spatial_aq", "1", "-temporal_aq", "1"]
+        if encoder == 'hevc_qsv':
+            return [], ["-c:v", "hevc_qsv", "-preset", "slower", "-global_quality", "22", "-profile:v", "main10", "-pix_fmt", "p010le"]
+        if encoder == 'hevc_vaapi':
+            return (["-vaapi_device", config.VAAPI_DEVICE],
+                    ["-vf", "format=p010,hwupload", "-c:v", "hevc_vaapi", "-profile:v", "main10", "-global_quality", "22"])
+        return [], ["-c:v", "libx265", "-preset", "slow", "-crf", "20.5", "-threads", str(_encode_threads()), "-x265-params", self._x265_params()]
+
+    @contextmanager
+    def _encode_slot(self):
+        """Waits for a free encode slot and holds it; encoders started meanwhile get its scheduling."""
+        with _encode_slots:
+            with _free_encode_slots_lock:
+                slot = _free_encode_slots.pop()
+            try:
+                pin = config.PIN_ENCODES and hasattr(os, 'sched_setaffinity')
+                self._encode_cpus = _slot_cpus(slot) if pin else set()
+                yield
+            finally:
+                self._encode_cpus = None
+                with _free_encode_slots_lock:
+                    _free_encode_slots.append(slot)
+
+    def _encode(self, function, *args):
+        """Runs an encode step's function inside an encode slot, so skipped steps never wait for one."""
+        with self._encode_slot():
+            return function(*args)
+
+    def _tune_encoder(self, process):
+        """
+        Runs an encoder process in the batch scheduling class, and on its slot's CPUs if encodes are
+        pinned. Threads the encoder starts later inherit both. No-op outside an encode slot.
+        """
+        if self._encode_cpus is None:
+            return
+        try:
+            if hasattr(os, 'SCHED_BATCH'):
+                os.sched_setscheduler(process.pid, os.SCHED_BATCH, os.sched_param(0))
+            if self._encode_cpus:
+                os.sched_setaffinity(process.pid, self._encode_cpus)
+                self.logger.info(f"Pinned encoder to CPUs {sorted(self._encode_cpus)}.")
+        except OSError as e:
+            # The process may already have exited; its exit code reports any failure
+            self.logger.warning(f"Could not set encoder scheduling: {e}")
+
+    def _x265_params(self):
+        """Returns the -x265-params value, with the thread pool sized from the config."""
+        if config.X265_POOLS != 'auto':
+            pools = config.X265_POOLS
+        elif config.MAX_CONCURRENT_ENCODES > 1:
+            pools = _encode_threads()
+        else:
+            pools = '+'
+        params = [f"pools={pools}"]
+        if config.X265_ASM != 'auto':
+            params.append(f"asm={config.X265_ASM}")
+        elif 'avx512f' in _cpu_flags():
+            params.append("asm=avx512")
+        if config.X265_FRAME_THREADS:
+            params.append(f"frame-threads={config.X265_FRAME_THREADS}")
+        params += ["no-sao=1", "early-skip=1", "rd=3", "me=hex"]
+        return ':'.join(params)
 
     def transcode(self):
+        try:
+            return self._transcode()
+        finally:
+            self._release_ram_reservation()
+            self._flush_log()
+
+    def _transcode(self):
         self.logger.info(f"=== Entering transcode() for job {self.job_id} ===")
-        import json
         try:
             self.logger.info(f"Job dict: {json.dumps(self.job, indent=2)}")
         except Exception as e:
@@ -394,7 +848,6 @@ class Transcoder:
             self.logger.error(f"Input file does not exist: {self.original_input_path}")
             raise FileNotFoundError(f"Input file does not exist: {self.original_input_path}")
         try:
-            import traceback
             job_type = self.job.get('job_type', 'standard') # Default to standard if type is missing
             self.logger.info(f"=== Starting transcode pipeline for job {self.job_id} ===")
             self.logger.info(f"Job dict: {self.job}")
@@ -403,7 +856,9 @@ class Transcoder:
             def run_step(step_name, description, file_to_check, function, *args, **kwargs):
                 if step_name not in self.job['steps']:
                     return True
-                if self.job['steps'].get(step_name) == 'completed' and os.path.exists(file_to_check):
+                # Steps that produce several files pass all of them
+                files_to_check = file_to_check if isinstance(file_to_check, tuple) else (file_to_check,)
+                if self.job['steps'].get(step_name) == 'completed' and all(os.path.exists(path) for path in files_to_check):
                     self.logger.info(f"Step '{step_name}' already completed. Skipping.")
                     print(f"- Skipping already completed step: {description}")
                     return True
@@ -429,6 +884,10 @@ class Transcoder:
                 if not run_step('get_metadata', 'Getting video metadata', self.log_file, self._get_video_metadata, self.local_source_path):
                     self.logger.error("transcode() failed during step: get_metadata")
                     return False
+                if self.total_frames is None:
+                    # The step was skipped on a resumed run; later steps still need its results,
+                    # which normally come from the cache
+                    self._get_video_metadata(self.local_source_path)
 
                 # Define output filenames first
                 if job_type == 'dolby_vision':
@@ -438,62 +897,70 @@ class Transcoder:
                 self.local_output_path = os.path.join(self.job_staging_dir, output_filename)
                 self.output_path = os.path.join(os.path.dirname(self.original_input_path), output_filename)
 
-                # Create a single quoted variable for use in commands
-                quoted_local_source_path = f'"{self.local_source_path}"'
-
                 # --- Dolby Vision Path --- 
                 if job_type == 'dolby_vision':
-                    video_stream_index = self._get_main_video_stream_index(self.local_source_path)
-                    if video_stream_index is None:
+                    if self.video_stream is None:
                         self.logger.error("Could not determine video stream index. Aborting job.")
                         return False
                     
-                    map_specifier = f"0:v:{video_stream_index}"
+                    map_specifier = f"0:v:{self.video_stream}"
                     self.logger.info(f"Using map specifier '{map_specifier}' for ffmpeg.")
 
-                    cmd1 = ["ffmpeg", "-i", quoted_local_source_path, "-map", map_specifier, "-c", "copy", "-y", f'"{self.p7_video_path}"']
-                    if not run_step('extract_p7', 'Extracting Profile 7 HEVC stream', self.p7_video_path, self._run_ffmpeg_copy_with_progress, cmd1, self.total_frames, self.frame_rate, "Extracting P7 stream"):
-                        self.logger.error("transcode() failed during step: extract_p7")
-                        return False
-
-                    cmd2 = ["dovi_tool", "-m", "2", "convert", "--discard", "-i", f'"{self.p7_video_path}"', "-o", f'"{self.p8_video_path}"']
-                    if not run_step('convert_p8', 'Converting P7 to P8.1', self.p8_video_path, self._run_dovi_tool_with_progress, cmd2, "Converting to P8.1"):
+                    # Extract the P7 stream and convert it to P8.1 in one go; the P7 stream is piped
+                    # straight into dovi_tool instead of being written to disk and read back. The
+                    # same stream is teed into the RPU extraction, which converts the RPU to P8.1
+                    # itself (-m 2), so that runs alongside instead of re-reading the P8.1 file.
+                    cmd_extract = ["ffmpeg", "-v", "error", "-nostats", "-progress", "pipe:2", "-i", self.local_source_path, "-map", map_specifier, "-c", "copy", "-f", "hevc", "-"]
+                    cmd_convert = ["dovi_tool", "-m", "2", "convert", "--discard", "-", "-o", self.p8_video_path]
+                    cmd_extract_rpu = ["dovi_tool", "-m", "2", "extract-rpu", "-", "-o", self.rpu_path]
+                    if not run_step('convert_p8', 'Extracting P7 stream, converting to P8.1 and extracting RPU', (self.p8_video_path, self.rpu_path), self._run_pipeline, cmd_extract, [cmd_convert, cmd_extract_rpu], self.total_frames, "Extracting and converting to P8.1"):
                         self.logger.error("transcode() failed during step: convert_p8")
                         return False
 
-                    cmd3 = ["dovi_tool", "extract-rpu", "-i", f'"{self.p8_video_path}"', "-o", f'"{self.rpu_path}"']
-                    if not run_step('extract_rpu', 'Extracting RPU', self.rpu_path, self._run_dovi_tool_with_progress, cmd3, "Extracting RPU"):
-                        self.logger.error("transcode() failed during step: extract_rpu")
-                        return False
-
-                    # Re-encode video only
-                    cmd4 = ["ffmpeg", "-fflags", "+genpts", "-i", f'"{self.p8_video_path}"', "-an", "-sn", "-dn", "-c:v", "libx265", "-preset", "slow", "-crf", "20.5", "-threads", "10", "-x265-params", "pools=10:no-sao=1:early-skip=1:rd=3:me=hex", "-y", f'"{self.reencoded_video_path}"']
-                    if not run_step('reencode_x265', 'Re-encoding to x265', self.reencoded_video_path, self._run_ffmpeg_with_progress, cmd4, self.total_frames, "Re-encoding to x265"):
-                        self.logger.error("transcode() failed during step: reencode_x265")
-                        return False
-
-                    # Inject RPU
-                    cmd5 = ["dovi_tool", "inject-rpu", "-i", f'"{self.reencoded_video_path}"', "--rpu-in", f'"{self.rpu_path}"', "-o", f'"{self.final_video_with_rpu_path}"']
-                    if not run_step('inject_rpu', 'Injecting RPU', self.final_video_with_rpu_path, self._run_dovi_tool_with_progress, cmd5, "Injecting RPU"):
-                        self.logger.error("transcode() failed during step: inject_rpu")
-                        return False
-
-                    # Remux final MKV
-                    cmd6 = ["mkvmerge", "-o", f'"{self.local_output_path}"', "--language", "0:eng", f'"{self.final_video_with_rpu_path}"', "--no-video", quoted_local_source_path]
-                    if not run_step('remux_final', 'Remuxing final MKV', self.local_output_path, self._run_command, cmd6, "Remuxing final MKV"):
-                        self.logger.error("transcode() failed during step: remux_final")
+                    # Copy the audio and subtitle tracks out of the source while the encode runs, when
+                    # the staging disk is mostly idle, so the remux doesn't re-read the whole source
+                    track_stash = None
+                    if self.job['steps'].get('remux_final') != 'completed':
+                        track_stash = self._start_track_stash()
+
+                    # Re-encode video only, piping the encoded stream straight into the RPU injection
+                    input_args, encoder_args = self._encoder_args()
+                    cmd_reencode = ["ffmpeg", "-nostats", "-progress", "pipe:2", "-fflags", "+genpts", *input_args, "-i", self.p8_video_path, "-an", "-sn", "-dn", *encoder_args, *_HDR10_COLOR_ARGS, "-f", "hevc", "-"]
+                    cmd_inject = ["dovi_tool", "inject-rpu", "-i", "-", "--rpu-in", self.rpu_path, "-o", self.final_video_with_rpu_path]
+                    try:
+                        reencoded = run_step('reencode_x265', 'Re-encoding to x265 and injecting RPU', self.final_video_with_rpu_path, self._encode, self._run_pipeline, cmd_reencode, [cmd_inject], self.total_frames, "Re-encoding to x265")
+                        if not reencoded:
+                            self.logger.error("transcode() failed during step: reencode_x265")
+                            return False
+                        self._drop_from_cache(self.p8_video_path)
+
+                        # Remux final MKV
+                        tracks_source = self.local_source_path
+                        if self._finish_track_stash(track_stash):
+                            tracks_source = self.track_stash_path
+                        cmd6 = ["mkvmerge", "-o", self.local_output_path, "--language", "0:eng", self.final_video_with_rpu_path, "--no-video", tracks_source]
+                        if not run_step('remux_final', 'Remuxing final MKV', self.local_output_path, self._run_command, cmd6, "Remuxing final MKV"):
+                            self.logger.error("transcode() failed during step: remux_final")
+                            return False
+                        self._drop_from_cache(self.final_video_with_rpu_path, self.track_stash_path, self.local_source_path)
+                    finally:
+                        if track_stash is not None and track_stash.poll() is None:
+                            track_stash.kill()
+                            track_stash.wait()
 
                 # --- Standard Path (Optimized) --- 
                 else: # 'standard' job type
+                    input_args, encoder_args = self._encoder_args()
                     cmd_reencode_mux = [
-                        "ffmpeg", "-fflags", "+genpts", "-i", quoted_local_source_path,
-                        "-map", "0", "-c:v", "libx265", "-preset", "slow", "-crf", "20.5",
-                        "-threads", "10", "-x265-params", "pools=10:no-sao=1:early-skip=1:rd=3:me=hex",
-                        "-c:a", "copy", "-c:s", "copy", "-y", f'"{self.local_output_path}"'
+                        "ffmpeg", "-fflags", "+genpts", *input_args, "-i", self.local_source_path,
+                        "-map", "0", *encoder_args,
+                        "-c:a", "copy", "-c:s", "copy", "-y", self.local_output_path
                     ]
-                    if not run_step('reencode_x265', 'Re-encoding and Muxing', self.local_output_path, self._run_ffmpeg_with_progress, cmd_reencode_mux, self.total_frames, "Re-encoding to x265"):
+                    reencoded = run_step('reencode_x265', 'Re-encoding and Muxing', self.local_output_path, self._encode, self._run_ffmpeg_with_progress, cmd_reencode_mux, self.total_frames, "Re-encoding to x265")
+                    if not reencoded:
                         self.logger.error("transcode() failed during step: reencode_x265")
                         return False
+                    self._drop_from_cache(self.local_source_path)
 
                 if not run_step('move_final', 'Moving final file to destination', self.output_path, self._move_final_file, self.local_output_path, self.output_path):
                     self.logger.error("transcode() failed during step: move_final")
@@ -507,78 +974,6 @@ class Transcoder:
                 print(f"- Unhandled exception in job pipeline. Check logs for details.")
                 self.logger.error(f"=== transcode() failed for job {self.job_id} ===")
                 return False
-                return False
-
-            # Define output filenames first
-            if job_type == 'dolby_vision':
-                output_filename = os.path.basename(self.original_input_path).replace('.mkv', '_DV_P8.mkv')
-            else: # standard
-                output_filename = os.path.basename(self.original_input_path).replace('.mkv', '_x265.mkv')
-            self.local_output_path = os.path.join(self.job_staging_dir, output_filename)
-            self.output_path = os.path.join(os.path.dirname(self.original_input_path), output_filename)
-
-            # --- Dolby Vision Path --- 
-            if job_type == 'dolby_vision':
-                video_stream_index = self._get_main_video_stream_index(self.local_source_path)
-                if video_stream_index is None:
-                    self.logger.error("Could not determine video stream index. Aborting job.")
-                    return False
-                
-                map_specifier = f"0:v:{video_stream_index}"
-                self.logger.info(f"Using map specifier '{map_specifier}' for ffmpeg.")
-
-                cmd1 = ["ffmpeg", "-i", f'"{self.local_source_path}"', "-map", map_specifier, "-c", "copy", "-y", f'"{self.p7_video_path}"']
-                if not run_step('extract_p7', 'Extracting Profile 7 HEVC stream', self.p7_video_path, self._run_ffmpeg_copy_with_progress, cmd1, self.total_frames, self.frame_rate, "Extracting P7 stream"):
-                    self.logger.error("transcode() failed during step: extract_p7")
-                    return False
-
-                cmd2 = ["dovi_tool", "-m", "2", "convert", "--discard", "-i", f'"{self.p7_video_path}"', "-o", f'"{self.p8_video_path}"']
-                if not run_step('convert_p8', 'Converting P7 to P8.1', self.p8_video_path, self._run_dovi_tool_with_progress, cmd2, "Converting to P8.1"):
-                    self.logger.error("transcode() failed during step: convert_p8")
-                    return False
-
-                cmd3 = ["dovi_tool", "extract-rpu", "-i", f'"{self.p8_video_path}"', "-o", f'"{self.rpu_path}"']
-                if not run_step('extract_rpu', 'Extracting RPU', self.rpu_path, self._run_dovi_tool_with_progress, cmd3, "Extracting RPU"):
-                    self.logger.error("transcode() failed during step: extract_rpu")
-                    return False
-
-                # Re-encode video only
-                cmd4 = ["ffmpeg", "-fflags", "+genpts", "-i", f'"{self.p8_video_path}"', "-an", "-sn", "-dn", "-c:v", "libx265", "-preset", "slow", "-crf", "20.5", "-threads", "10", "-x265-params", "pools=10:no-sao=1:early-skip=1:rd=3:me=hex", "-y", f'"{self.reencoded_video_path}"']
-                if not run_step('reencode_x265', 'Re-encoding to x265', self.reencoded_video_path, self._run_ffmpeg_with_progress, cmd4, self.total_frames, "Re-encoding to x265"):
-                    self.logger.error("transcode() failed during step: reencode_x265")
-                    return False
-
-                # Inject RPU
-                cmd5 = ["dovi_tool", "inject-rpu", "-i", f'"{self.reencoded_video_path}"', "--rpu-in", f'"{self.rpu_path}"', "-o", f'"{self.final_video_with_rpu_path}"']
-                if not run_step('inject_rpu', 'Injecting RPU', self.final_video_with_rpu_path, self._run_dovi_tool_with_progress, cmd5, "Injecting RPU"):
-                    self.logger.error("transcode() failed during step: inject_rpu")
-                    return False
-
-                # Remux final MKV
-                cmd6 = ["mkvmerge", "-o", f'"{self.local_output_path}"', "--language", "0:eng", f'"{self.final_video_with_rpu_path}"', "--no-video", f'"{self.local_source_path}"']
-                if not run_step('remux_final', 'Remuxing final MKV', self.local_output_path, self._run_command, cmd6, "Remuxing final MKV"):
-                    self.logger.error("transcode() failed during step: remux_final")
-                    return False
-
-            # --- Standard Path (Optimized) --- 
-            else: # 'standard' job type
-                cmd_reencode_mux = [
-                    "ffmpeg", "-fflags", "+genpts", "-i", f'"{self.local_source_path}"',
-                    "-map", "0", "-c:v", "libx265", "-preset", "slow", "-crf", "20.5",
-                    "-threads", "10", "-x265-params", "pools=10:no-sao=1:early-skip=1:rd=3:me=hex",
-                    "-c:a", "copy", "-c:s", "copy", "-y", f'"{self.local_output_path}"'
-                ]
-                if not run_step('reencode_x265', 'Re-encoding and Muxing', self.local_output_path, self._run_ffmpeg_with_progress, cmd_reencode_mux, self.total_frames, "Re-encoding to x265"):
-                    self.logger.error("transcode() failed during step: reencode_x265")
-                    return False
-
-            if not run_step('move_final', 'Moving final file to destination', self.output_path, self._move_final_file, self.local_output_path, self.output_path):
-                self.logger.error("transcode() failed during step: move_final")
-                return False
-
-            print(f"\nSuccessfully transcoded {os.path.basename(self.original_input_path)} to {self.output_path}")
-            self.logger.info(f"=== transcode() completed successfully for job {self.job_id} ===")
-            return True
         except Exception as e:
             self.logger.error(f"UNHANDLED EXCEPTION in job pipeline: {e}", exc_info=True)
             print(f"- Unhandled exception in job pipeline. Check logs for details.")
@@ -586,8 +981,20 @@ class Transcoder:
             return False
 
     def _copy_source_file(self):
+        if self.local_source_path == self.original_input_path:
+            self.logger.info("Reading the source in place (READ_SOURCE_IN_PLACE); not copying it.")
+            return True
         try:
             source_size = os.path.getsize(self.original_input_path)
+            if os.stat(self.original_input_path).st_dev == os.stat(self.job_staging_dir).st_dev:
+                # Same filesystem: a hard link gives staging its own name for the file without
+                # copying anything, and cleanup only removes the link
+                try:
+                    os.link(self.original_input_path, self.local_source_path)
+                    self.logger.info(f"Linked source file into staging: {self.local_source_path}")
+                    return True
+                except OSError as e:
+                    self.logger.info(f"Could not hard link the source ({e}); copying it instead.")
             # No need to check for existence here because the run_step wrapper does it
             if not self._copy_with_progress(self.original_input_path, self.local_source_path, "Copying source file locally"):
                 return False
@@ -597,9 +1004,24 @@ class Transcoder:
         return True
 
     def cleanup(self):
+        # transcode() detached the log file when it finished
+        self._setup_logger()
         self.logger.info(f"Cleaning up job staging directory: {self.job_staging_dir}")
         try:
             if os.path.exists(self.job_staging_dir):
-                shutil.rmtree(self.job_staging_dir)
+                # Move the directory out of the way and delete it in the background, so the
+                # next job doesn't wait for tens of GB of intermediates to be unlinked
+                trash_dir = f"{self.job_staging_dir}.trash-{os.getpid()}-{time.time_ns()}"
+                os.rename(self.job_staging_dir, trash_dir)
+                _reap(trash_dir)
         except OSError as e:
             self.logger.error(f"Error removing staging directory {self.job_staging_dir}: {e}")
+        for path in (self.rpu_path, self.p8_video_path, self.final_video_with_rpu_path):
+            # Files kept on the RAM disk rather than in the staging directory
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            except OSError as e:
+                self.logger.error(f"Error removing temporary file {path}: {e}")
+        self._release_ram_reservation()
+        self._flush_log()
@@ -48,44 +48,68 @@ def scan_and_add_jobs(directory_path, job_queue):
         print(f"Error: Directory not found: {directory_path}")
         return
 
-    added_count = 0
+    # Fetch the queued paths once so already-queued files don't need to be probed
+    known_paths = job_queue.get_all_file_paths() or set()
+
+    new_jobs = []
     for root, _, files in os.walk(directory_path):
         for file in files:
             if file.lower().endswith('.mkv') and '_DV_P8' not in file:
                 full_path = os.path.join(root, file)
+                if full_path in known_paths:
+                    print(f"- Found: {file}")
+                    print(f"  -> Job already exists. Skipping.")
+                    continue
+
                 job_type = 'dolby_vision' if is_dolby_vision(full_path) else 'standard'
                 print(f"- Found: {file} (Type: {job_type})")
-                
-                if job_queue.add_job(full_path, job_type):
-                    print(f"  -> Added job to queue.")
-                    added_count += 1
-                else:
-                    print(f"  -> Job already exists. Skipping.")
-    
-    print(f"\nScan complete. Added {added_count} new jobs.")
+                new_jobs.append((full_path, job_type))
+                known_paths.add(full_path)
+
+    # Add everything that was found in one queue transaction
+    results = job_queue.add_jobs(new_jobs)
+    for (full_path, _), added in zip(new_jobs, results):
+        if not added:
+            print(f"- {os.path.basename(full_path)}: job already exists. Skipping.")
+
+    print(f"\nScan complete. Added {sum(results)} new jobs.")
 
 def add_specific_files(paths, job_queue):
     """
     Adds a list of specific files to the job queue after determining their type.
     """
     print(f"Processing {len(paths)} specific path(s)...")
+    known_paths = job_queue.get_all_file_paths() or set()
+    new_jobs = []
     for path in paths:
-        if os.path.isfile(path) and path.endswith('.mkv'):
+        if path in known_paths:
+            print(f"- Skipped (already in queue): {path}")
+        elif os.path.isfile(path) and path.endswith('.mkv'):
             job_type = 'dolby_vision' if is_dolby_vision(path) else 'standard'
-            job_queue.add_job(path, job_type)
-            print(f"- Added file: {os.path.basename(path)} (Type: {job_type})")
+            new_jobs.append((path, job_type))
+            known_paths.add(path)
         elif os.path.isdir(path):
             print(f"- Scanning directory: {path}")
             for root, _, files in os.walk(path):
                 for file in files:
                     if file.endswith('.mkv'):
                         file_path = os.path.join(root, file)
+                        if file_path in known_paths:
+                            print(f"  - Skipped (already in queue): {os.path.basename(file_path)}")
+                            continue
                         job_type = 'dolby_vision' if is_dolby_vision(file_path) else 'standard'
-                        job_queue.add_job(file_path, job_type)
-                        print(f"  - Added file: {os.path.basename(file_path)} (Type: {job_type})")
+                        new_jobs.append((file_path, job_type))
+                        known_paths.add(file_path)
         else:
             print(f"- Skipped (not a valid .mkv file or directory): {path}")
 
+    # Add everything that was found in one queue transaction
+    for (file_path, job_type), added in zip(new_jobs, job_queue.add_jobs(new_jobs)):
+        if added:
+            print(f"- Added file: {os.path.basename(file_path)} (Type: {job_type})")
+        else:
+            print(f"- Skipped (already in queue): {os.path.basename(file_path)}")
+
 def add_test_file(job_queue):
     """
     Adds the specific test file to the queue as a 'dolby_vision' job.
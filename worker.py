@@ -1,33 +1,61 @@
 # worker.py
 
+import atexit
 import logging
+import logging.handlers
+import queue
 import socket
-import time
+import threading
 import sys
 import os
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 # Add project root to the Python path
 project_root = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, project_root)
 
-from mkv_transcoder.job_queue import JobQueue
-from mkv_transcoder.transcoder import Transcoder
-
-# Basic logging configuration for the worker itself
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+from mkv_transcoder.job_queue import JobQueue, MAX_RETRIES, STEP_ORDER, STEP_INDEX
+from mkv_transcoder.transcoder import Transcoder, remove_ram_files, sweep_ram_files, sweep_trash_dirs
+
+# Basic logging configuration for the worker itself. Records are handed to a background
+# thread that does the actual writing, so logging never blocks while the job queue is locked.
+# The QueueHandler formats each record before queueing it, so the writer needs no formatter.
+_log_queue = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+                    handlers=[logging.handlers.QueueHandler(_log_queue)])
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+# Set when the worker is interrupted, so that job slots stop claiming new jobs
+stop_requested = threading.Event()
+
+def step_index(value):
+    """argparse type for --force-rerun: accepts a 1-based step index or a step name."""
+    if value in STEP_INDEX:
+        return STEP_INDEX[value]
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"unknown step '{value}'")
 
 def main():
     parser = argparse.ArgumentParser(description="MKV Transcoder Worker")
-    parser.add_argument('--force-rerun', type=int, metavar='STEP_INDEX', help='Force the job to re-run starting from the specified step index (1-8).')
+    parser.add_argument('--force-rerun', type=step_index, metavar='STEP', help=f'Force the job to re-run starting from the specified step, by index (1-{len(STEP_ORDER)}) or name ({", ".join(STEP_ORDER)}).')
     parser.add_argument('--job-id', type=str, help='(Optional) Job ID to force re-run. Required if --force-rerun is used.')
     parser.add_argument('--input-path', type=str, help='(Optional) Input path to force re-run. Required if --force-rerun is used and --job-id is not given.')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of jobs to transcode concurrently on this machine (default: 1). Encodes are still limited to config.MAX_CONCURRENT_ENCODES at a time.')
     args = parser.parse_args()
 
     worker_id = socket.gethostname()
     job_queue = JobQueue()
     logging.info(f"Worker '{worker_id}' started. Polling for jobs...")
 
+    # Staging directories a killed worker moved aside but didn't get to delete
+    if sweep_trash_dirs():
+        logging.info("Deleting staging directories left behind by an earlier worker in the background.")
+
     if args.force_rerun:
         if not args.job_id and not args.input_path:
             logging.error("--force-rerun requires either --job-id or --input-path to specify which job to reset.")
@@ -44,39 +72,43 @@ def main():
             sys.exit(1)
         logging.warning(f"--force-rerun flag detected. Forcibly resetting job (ID: {args.job_id}, Input: {args.input_path}) to start from step {args.force_rerun}.")
 
-        # Claim and process ONLY the specified job
-        def _find_job(queue):
-            for job in queue['jobs']:
-                if (args.job_id and job.get('id') == args.job_id) or (args.input_path and job.get('input_path') == args.input_path):
-                    return job
-            return None
-        target_job = job_queue._execute_with_lock(_find_job)
+        # Claim and process ONLY the specified job (sets worker_id and claimed_at)
+        target_job = job_queue.claim_job(worker_id, job_id=args.job_id, input_path=args.input_path)
         if not target_job:
             logging.error("Could not find job to process after reset.")
             sys.exit(1)
-        # Set worker_id and claimed_at
-        target_job['worker_id'] = worker_id
-        target_job['claimed_at'] = time.time()
-        # Save
-        def _update_job(queue):
-            for job in queue['jobs']:
-                if job['id'] == target_job['id']:
-                    job.update(target_job)
-                    return True
-            return False
-        job_queue._execute_with_lock(_update_job)
         logging.info(f"Worker '{worker_id}' claimed job {target_job['id']} for file: {target_job['input_path']}")
         # Process the job as usual
         try:
-            # Quote the path for shell compatibility
-            target_job['input_path'] = f'"{target_job["input_path"]}"'
             transcoder = Transcoder(target_job, job_queue)
             transcoder.transcode()
         except Exception as e:
             logging.error(f"Job {target_job['id']} failed during transcoding.")
         sys.exit(0)
 
-    while True:
+    if args.jobs > 1:
+        # Each slot claims and transcodes jobs on its own, with its own queue handle
+        with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            futures = [executor.submit(process_jobs, f"{worker_id}-{slot}", JobQueue()) for slot in range(1, args.jobs + 1)]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                # Let the other slots finish their current job, but don't claim new ones
+                stop_requested.set()
+                raise
+    else:
+        process_jobs(worker_id, job_queue)
+
+def process_jobs(worker_id, job_queue):
+    """Claims and transcodes jobs until the queue has none left."""
+    while not stop_requested.is_set():
+        # Free the RAM disk of intermediates of jobs that have since finished (possibly on another
+        # machine) or been given up on, before this job decides whether its own fit there
+        removed = sweep_ram_files(job_queue)
+        if removed:
+            logging.info(f"Removed {len(removed)} leftover file(s) of finished jobs from the RAM disk.")
+
         job = job_queue.claim_next_available_job(worker_id)
 
         if not job:
@@ -85,23 +117,12 @@ def main():
 
         logging.info(f"Worker '{worker_id}' claimed job {job['id']} for file: {job['input_path']}")
 
-        # If --force-rerun is used, reset the job progress before transcoding
-        if args.force_rerun and not rerun_flag_applied:
-            logging.warning(f"--force-rerun flag detected. Resetting job {job['id']} to start from step {args.force_rerun}.")
-            job_queue.reset_job_progress(job['id'], args.force_rerun)
-            # The job object is now stale, so we must refetch it to get the updated step statuses.
-            # We can re-claim it, which is safe because we already have it marked as 'running'.
-            job = job_queue.claim_next_available_job(worker_id)
-            rerun_flag_applied = True
-
         transcoder = None
         success = False
         if job is None:
             logging.warning("No available job to process (job is None). Skipping processing.")
         else:
             try:
-                # Quote the path for shell compatibility
-                job['input_path'] = f'"{job["input_path"]}"'
                 transcoder = Transcoder(job=job, job_queue=job_queue)
                 success = transcoder.transcode()
 
@@ -111,6 +132,10 @@ def main():
                 else:
                     logging.error(f"Job {job['id']} failed during transcoding.")
                     job_queue.update_job_status(job['id'], 'failed')
+                    if job.get('retries', 0) >= MAX_RETRIES:
+                        # The job will be quarantined rather than retried, so nothing will resume
+                        # from its intermediates; don't leave them pinned in RAM
+                        remove_ram_files(job['id'])
 
             except BaseException as e:
                 # Catching BaseException to handle KeyboardInterrupt and other critical errors
@@ -122,6 +147,8 @@ def main():
                 
                 if job:
                     job_queue.update_job_status(job_id, 'failed')
+                    if job.get('retries', 0) >= MAX_RETRIES:
+                        remove_ram_files(job_id)
                 
                 # Re-raise the exception to ensure the worker process terminates
                 raise